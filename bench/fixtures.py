@@ -0,0 +1,274 @@
+"""
+Synthetic upstream data for the benchmarks: a fixed NFL player pool, Sleeper and ESPN leagues drafted from it, and
+the payloads each upstream would serve for them. Everything is derived from a seed, so runs are comparable.
+"""
+
+import datetime
+import json
+import random
+
+import pytz
+from espn_api.football.constant import PRO_TEAM_MAP
+
+from identity import translate_team
+
+
+TEAMS = sorted(code for team_id, code in PRO_TEAM_MAP.items() if team_id)
+DEPTH = {'QB': 2, 'RB': 4, 'WR': 6, 'TE': 3, 'K': 1}
+TEAMS_PER_LEAGUE = 10
+ROSTER_SIZE = 16
+ESPN_SLOTS = {'0': 1, '2': 2, '4': 2, '6': 1, '23': 1, '16': 1, '17': 1, '20': 6, '21': 1}
+SLEEPER_SLOTS = ['QB', 'RB', 'RB', 'WR', 'WR', 'TE', 'FLEX', 'FLEX', 'K', 'DEF'] + ['BN'] * 6
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis', 'Wilson', 'Moore', 'Taylor']
+FIRST_NAMES = ['James', 'Michael', 'Chris', 'David', 'Josh', 'Justin', 'Tyler', 'Jalen', 'Derrick', 'Travis']
+
+
+class Fixtures:
+
+    def __init__(self, leagues: int, profiles: int, seasons: int, week: int, seed: int = 1):
+        self.week = week
+        self.year = datetime.datetime.utcnow().year
+        self.random = random.Random(seed)
+        self.players = self.build_players()
+        self.leagues = [self.build_league(i, seasons) for i in range(leagues)]
+        self.profiles = self.build_profiles(profiles)
+        self.kickoff = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=1)
+
+    def build_players(self) -> list:
+
+        players = []
+
+        for team in TEAMS:
+            for position, depth in DEPTH.items():
+                for rank in range(depth):
+                    number = len(players) + 1000
+                    players.append({
+                        'sleeper_id': str(number),
+                        'espn_id': number * 7,
+                        'yahoo_id': number * 3,
+                        'name': f"{FIRST_NAMES[number % 10]} {LAST_NAMES[(number // 10) % 10]}{number}",
+                        'team': team,
+                        'position': position,
+                        'projection': round(self.random.uniform(2, 25) / (rank + 1), 2),
+                    })
+            players.append({
+                'sleeper_id': translate_team('espn', 'sleeper', team),
+                'espn_id': -16000 - TEAMS.index(team),
+                'yahoo_id': None,
+                'name': f"{team} D/ST",
+                'team': team,
+                'position': 'DST',
+                'projection': round(self.random.uniform(3, 12), 2),
+            })
+
+        return players
+
+    def build_league(self, index: int, seasons: int) -> dict:
+
+        pool = list(self.players)
+        self.random.shuffle(pool)
+
+        return {
+            'league_id': 100000 + index,
+            'name': f"League {index}",
+            'platform': 'espn' if index % 2 == 0 else 'sleeper',
+            'scoring': 'ppr' if index % 3 else 'half-point-ppr',
+            'start_year': self.year - seasons + 1,
+            'rosters': {team_id: pool[(team_id - 1) * ROSTER_SIZE:team_id * ROSTER_SIZE] for team_id in range(1, TEAMS_PER_LEAGUE + 1)},
+        }
+
+    def build_profiles(self, count: int) -> list:
+        """ leagues table rows; each profile follows an even share of the leagues, at least one """
+
+        rows = []
+        share = max(1, len(self.leagues) // count)
+
+        for profile in range(count):
+            for offset in range(share):
+                league = self.leagues[(profile * share + offset) % len(self.leagues)]
+                rows.append({
+                    'profile': f"profile{profile}",
+                    'name': league.get('name'),
+                    'platform': league.get('platform'),
+                    'scoring': league.get('scoring'),
+                    'league_id': league.get('league_id'),
+                    'team_id': 1 + profile % TEAMS_PER_LEAGUE,
+                    'start_year': league.get('start_year'),
+                    'swid': '{bench}' if league.get('platform') == 'espn' else None,
+                    's2': 'bench' if league.get('platform') == 'espn' else None,
+                })
+
+        return rows
+
+    def league(self, league_id: int) -> dict:
+        return self.leagues[league_id - 100000]
+
+    def points(self, league_id: int, player: dict, week: int) -> float:
+        """ Stable per league, player and week, so repeated fetches of an unchanged week return the same scores """
+        return round(random.Random(f"{league_id}-{player.get('sleeper_id')}-{week}").uniform(0, 2) * player.get('projection'), 2)
+
+    def starters(self, roster: list) -> list:
+        return sorted(roster, key=lambda p: -p.get('projection'))[:9]
+
+    # Sleeper
+
+    def sleeper_players(self) -> dict:
+
+        catalog = {}
+
+        for player in self.players:
+            position = 'DEF' if player.get('position') == 'DST' else player.get('position')
+            catalog[player.get('sleeper_id')] = {
+                'full_name': None if position == 'DEF' else player.get('name'),
+                'last_name': player.get('team') if position == 'DEF' else player.get('name').split(' ')[1],
+                'team': translate_team('espn', 'sleeper', player.get('team')),
+                'position': position,
+                'fantasy_positions': [position],
+                'injury_status': None,
+                'espn_id': player.get('espn_id') if position != 'DEF' else None,
+                'yahoo_id': player.get('yahoo_id'),
+            }
+
+        return catalog
+
+    def sleeper_league(self, league_id: int) -> dict:
+        return {'league_id': str(league_id), 'roster_positions': SLEEPER_SLOTS}
+
+    def sleeper_rosters(self, league_id: int) -> list:
+        return [{'roster_id': team_id, 'owner_id': f"u{team_id}"} for team_id in self.league(league_id).get('rosters')]
+
+    def sleeper_users(self, league_id: int) -> list:
+        return [
+            {'user_id': f"u{team_id}", 'display_name': f"Owner {team_id}", 'metadata': {'team_name': f"Team {team_id}"}}
+            for team_id in self.league(league_id).get('rosters')
+        ]
+
+    def sleeper_matchups(self, league_id: int, week: int) -> list:
+
+        matchups = []
+
+        for team_id, roster in self.league(league_id).get('rosters').items():
+            matchups.append({
+                'roster_id': team_id,
+                'matchup_id': (team_id + 1) // 2,
+                'players': [p.get('sleeper_id') for p in roster],
+                'starters': [p.get('sleeper_id') for p in self.starters(roster)],
+                'players_points': {p.get('sleeper_id'): self.points(league_id, p, week) for p in roster},
+            })
+
+        return matchups
+
+    # ESPN
+
+    def espn_league(self, league_id: int) -> dict:
+
+        rosters = self.league(league_id).get('rosters')
+
+        return {
+            'members': [{'id': f"m{team_id}", 'firstName': 'Owner', 'lastName': str(team_id)} for team_id in rosters],
+            'teams': [{'id': team_id, 'name': f"Team {team_id}", 'owners': [f"m{team_id}"]} for team_id in rosters],
+            'settings': {'rosterSettings': {'lineupSlotCounts': ESPN_SLOTS}},
+        }
+
+    def espn_schedule(self) -> dict:
+
+        games = []
+
+        for home, away in zip(TEAMS[0::2], TEAMS[1::2]):
+            games.append({
+                'competitions': [{
+                    'competitors': [{'team': {'abbreviation': home}}, {'team': {'abbreviation': away}}],
+                    'status': {'period': 3, 'clock': 450, 'displayClock': '7:30'},
+                }],
+            })
+
+        return {'content': {'schedule': {'20241006': {'games': games}}}}
+
+    # FantasyPros
+
+    def fantasypros_page(self, position: str) -> str:
+
+        players = [
+            {
+                'player_name': f"Team {p.get('team')}" if p.get('position') == 'DST' else p.get('name'),
+                'player_team_id': translate_team('espn', 'fp', p.get('team')),
+                'player_position_id': p.get('position'),
+                'player_yahoo_id': p.get('yahoo_id'),
+                'r2p_pts': str(p.get('projection')),
+            }
+            for p in self.players if p.get('position') == position.upper()
+        ]
+
+        return f"<html><script>\nvar ecrData = {json.dumps({'players': players})};\n</script></html>"
+
+
+class SyntheticLeague:
+    """ Stands in for espn_api's League: box scores built from the fixtures instead of ESPN's API """
+
+    fixtures = None
+
+    def __init__(self, league_id: int, year: int, espn_s2: str = None, swid: str = None):
+        self.league_id = league_id
+        self.year = year
+        # Past seasons are over, and the current one is on the fixtures' week, as ESPN reports them
+        self.current_week = self.fixtures.week if year >= self.fixtures.year else 18
+
+    def box_scores(self, week: int) -> list:
+
+        fixtures = self.fixtures
+        league = fixtures.league(self.league_id)
+        teams = league.get('rosters')
+        scores = []
+
+        for home_id in range(1, len(teams) + 1, 2):
+            scores.append(BoxScore(
+                SyntheticTeam(home_id), SyntheticTeam(home_id + 1),
+                self.lineup(teams.get(home_id), week), self.lineup(teams.get(home_id + 1), week),
+            ))
+
+        return scores
+
+    def lineup(self, roster: list, week: int) -> list:
+
+        starters = self.fixtures.starters(roster)
+
+        return [
+            SyntheticPlayer(player, self.fixtures.points(self.league_id + self.year, player, week), player in starters, self.fixtures.kickoff)
+            for player in roster
+        ]
+
+
+class SyntheticTeam:
+
+    def __init__(self, team_id: int):
+        self.team_id = team_id
+        self.owner = f"Owner {team_id}"
+
+
+class SyntheticPlayer:
+
+    def __init__(self, player: dict, points: float, starter: bool, kickoff: datetime.datetime):
+        self.name = player.get('name')
+        self.playerId = player.get('espn_id')
+        self.proTeam = player.get('team')
+        self.injuryStatus = 'ACTIVE'
+        self.position = 'D/ST' if player.get('position') == 'DST' else player.get('position')
+        self.slot_position = self.position if starter else 'BE'
+        self.points = points
+        self.projected_points = player.get('projection')
+        self.game_date = kickoff
+        self.game_played = 50
+
+
+class BoxScore:
+
+    def __init__(self, home_team, away_team, home_lineup, away_lineup):
+        self.home_team = home_team
+        self.away_team = away_team
+        self.home_lineup = home_lineup
+        self.away_lineup = away_lineup
+        self.home_score = round(sum(p.points for p in home_lineup if p.slot_position != 'BE'), 2)
+        self.away_score = round(sum(p.points for p in away_lineup if p.slot_position != 'BE'), 2)
+        self.home_projected = round(sum(p.projected_points for p in home_lineup if p.slot_position != 'BE'), 2)
+        self.away_projected = round(sum(p.projected_points for p in away_lineup if p.slot_position != 'BE'), 2)
+        self.is_playoff = False
@@ -0,0 +1,220 @@
+"""
+Offline benchmarks for the ingest and page paths as leagues, profiles and seasons grow.
+
+ESPN, Sleeper and FantasyPros are served by a local stub from synthetic fixtures, ESPN box scores come from a
+synthetic League, and a throwaway SQLite store stands in for BigQuery. Each scenario runs in its own process, so no
+cache carries over between them.
+
+    python bench/run.py                      run every scenario and compare against bench/baseline.json
+    python bench/run.py --save               also write the results as the new baseline
+    python bench/run.py --check              exit 1 if any p50 regressed past the threshold
+    python bench/run.py --scenario leagues-10
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+WEEK = 5
+REPEATS = 5
+THRESHOLD = 0.5
+
+# name -> (leagues, profiles, seasons)
+SCENARIOS = {
+    'leagues-1': (1, 1, 1),
+    'leagues-10': (10, 1, 1),
+    'leagues-100': (100, 1, 1),
+    'profiles-10': (20, 10, 1),
+    'profiles-50': (20, 50, 1),
+    'seasons-5': (2, 1, 5),
+    'seasons-15': (2, 1, 15),
+}
+
+
+def run_scenario(name: str) -> dict:
+
+    leagues, profiles, seasons = SCENARIOS.get(name)
+    data_dir = tempfile.mkdtemp(prefix='commander-bench-')
+
+    # Rate limits are lifted so the numbers measure the code rather than the ESPN throttle
+    os.environ.update({
+        'COMMANDER_STORE': 'sqlite',
+        'COMMANDER_ARCHIVE': '',
+        'COMMANDER_DATA_DIR': data_dir,
+        'COMMANDER_ESPN_RATE': '10000',
+        'COMMANDER_ESPN_BURST': '10000',
+    })
+    sys.path.insert(0, ROOT)
+
+    import fixtures
+    import helpers
+    import main
+    import pipeline
+    import stub
+    from storage import get_store
+
+    data = fixtures.Fixtures(leagues, profiles, seasons, WEEK)
+    server = stub.StubServer(data).start()
+
+    helpers.SLEEPER_URL = f"{server.url}/sleeper"
+    helpers.FANTASYPROS_URL = f"{server.url}/fantasypros"
+    helpers.ESPN_API_URL = f"{server.url}/espn"
+    helpers.ESPN_CDN_URL = f"{server.url}/cdn"
+    helpers.League = fixtures.SyntheticLeague
+    helpers.get_current_week = lambda: WEEK
+    fixtures.SyntheticLeague.fixtures = data
+
+    get_store().write('leagues', data.profiles)
+
+    results = {}
+
+    def measure(metric: str, fn, units: int = 1, repeats: int = REPEATS):
+
+        samples = []
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+
+        record(metric, samples, units)
+
+    def record(metric: str, samples: list, units: int = 1):
+        p50 = statistics.median(samples)
+        results[metric] = {
+            'p50': p50,
+            'p95': sorted(samples)[min(len(samples) - 1, int(len(samples) * 0.95))],
+            'per_second': units / p50 if p50 else None,
+        }
+
+    def cycle(*sources):
+        results = pipeline.run(WEEK, sources or pipeline.SOURCES)
+        assert all(results.values()), results
+
+    try:
+
+        # As /update/all does, so projections and scores are matched against the player index
+        main.refresh_players()
+
+        # Each source on its own, under the name of the stage it is timed as
+        measure('update_teams', lambda: cycle('teams'), leagues)
+        measure('update_progress', lambda: cycle('progress'))
+        measure('update_projections (cold)', lambda: cycle('projections'), repeats=1)
+        measure('update_projections (warm)', lambda: cycle('projections'))
+        measure('update_all_scores (cold)', lambda: cycle('scores'), leagues, repeats=1)
+        measure('update_all_scores (warm)', lambda: cycle('scores'), leagues)
+        measure('pipeline cycle', cycle, leagues)
+
+        for mode in ('default', 'max'):
+            samples = []
+            for _ in range(REPEATS):
+                for profile in helpers.load_profiles().keys():
+                    start = time.perf_counter()
+                    helpers.get_all_matchups(profile, WEEK, mode)
+                    samples.append(time.perf_counter() - start)
+            record(f"get_all_matchups ({mode})", samples)
+
+        teams = {}
+        for row in get_store().select('scores', {'week': WEEK}):
+            teams.setdefault((row.league_id, row.team_id), []).append(dict(row, projected=row.points))
+
+        measure('organize_team (max)', lambda: [helpers.organize_team([dict(p) for p in players], 'max') for players in teams.values()], len(teams))
+
+        client = main.app.test_client()
+        measure('/records (cold)', lambda: client.get('/records'), repeats=1)
+        measure('/records (warm)', lambda: client.get('/records'))
+
+        results['upstream requests'] = {'count': server.requests}
+
+    finally:
+        server.stop()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    return results
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """ Prints every metric next to its baseline and returns the ones whose p50 got slower than THRESHOLD """
+
+    regressions = []
+
+    for scenario, metrics in results.items():
+        for metric, values in metrics.items():
+
+            if 'p50' not in values:
+                print(f"{scenario:<14} {metric:<28} {values.get('count'):>10}")
+                continue
+
+            before = baseline.get('scenarios', {}).get(scenario, {}).get(metric, {}).get('p50')
+            change = ''
+
+            if before:
+                ratio = values.get('p50') / before - 1
+                change = f"{ratio:+.0%}"
+                if ratio > THRESHOLD:
+                    change += '  REGRESSION'
+                    regressions.append((scenario, metric))
+
+            per_second = f"{values.get('per_second'):>10.1f}/s" if values.get('per_second') else ''
+            print(f"{scenario:<14} {metric:<28} {values.get('p50') * 1000:>10.1f} ms {values.get('p95') * 1000:>10.1f} ms {per_second:>12} {change}")
+
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS.keys(), help='run only these scenarios')
+    parser.add_argument('--save', action='store_true', help='write the results to bench/baseline.json')
+    parser.add_argument('--check', action='store_true', help='exit 1 when a metric regressed')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child)))
+        return
+
+    results = {}
+
+    for name in args.scenario or SCENARIOS.keys():
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name], capture_output=True, text=True, cwd=ROOT)
+        if child.returncode:
+            sys.exit(f"{name} failed:\n{child.stderr}")
+        results[name] = json.loads(child.stdout.strip().splitlines()[-1])
+
+    baseline = {}
+
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    print(f"{'scenario':<14} {'metric':<28} {'p50':>13} {'p95':>13} {'throughput':>12}")
+    regressions = compare(results, baseline)
+
+    if args.save:
+        with open(BASELINE, 'w') as f:
+            json.dump({
+                'generated': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'scenarios': {**baseline.get('scenarios', {}), **results},
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.check and regressions:
+        sys.exit(f"{len(regressions)} regressions past {THRESHOLD:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Local HTTP server answering for Sleeper, FantasyPros and ESPN from a Fixtures instance. Each upstream lives under its
+own path prefix, so pointing helpers' base URLs at it takes one assignment each.
+"""
+
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class StubServer:
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='stub', daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def route(self, path: str):
+        """ Returns (content type, body) for a path, or None when nothing answers there """
+
+        fixtures = self.fixtures
+
+        routes = [
+            (r'/sleeper/players/nfl', lambda: fixtures.sleeper_players()),
+            (r'/sleeper/league/(\d+)/matchups/(\d+)', lambda league_id, week: fixtures.sleeper_matchups(int(league_id), int(week))),
+            (r'/sleeper/league/(\d+)/rosters', lambda league_id: fixtures.sleeper_rosters(int(league_id))),
+            (r'/sleeper/league/(\d+)/users', lambda league_id: fixtures.sleeper_users(int(league_id))),
+            (r'/sleeper/league/(\d+)', lambda league_id: fixtures.sleeper_league(int(league_id))),
+            (r'/espn/seasons/\d+/segments/0/leagues/(\d+)', lambda league_id: fixtures.espn_league(int(league_id))),
+            (r'/cdn/core/nfl/schedule', lambda: fixtures.espn_schedule()),
+        ]
+
+        for pattern, build in routes:
+            match = re.fullmatch(pattern, path)
+            if match:
+                return 'application/json', json.dumps(build(*match.groups())).encode()
+
+        match = re.fullmatch(r'/fantasypros/nfl/rankings/(?:[a-z-]+-)?(qb|rb|wr|te|k|dst)\.php', path)
+
+        if match:
+            return 'text/html; charset=utf-8', fixtures.fantasypros_page(match.group(1)).encode()
+
+        return None
+
+    def handler(self):
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+
+                with stub.lock:
+                    stub.requests += 1
+
+                found = stub.route(urlsplit(self.path).path)
+
+                if found is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                content_type, body = found
+                etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
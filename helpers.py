@@ -1,83 +1,194 @@
 import datetime
+import gzip
 import json
-import math
+import os
+import re
 import threading
 import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import pytz
 import requests
-from bs4 import BeautifulSoup
 from espn_api.football import League
-from espn_api.requests.espn_requests import ESPNAccessDenied
-from google.cloud import bigquery
+from espn_api.football.constant import POSITION_MAP
+from espn_api.requests import espn_requests
+from espn_api.requests.espn_requests import ESPNAccessDenied, ESPNInvalidLeague, ESPNUnknownError
+
+import http_client
+import identity
+import metrics
+import projection_changes
+import winprob
+from leaderboards import Leaderboard
+from identity import translate_team
+from lineups import DEFAULT_SLOTS, RESERVE_SLOTS, optimal_lineup
+from storage import DATA_DIR, Batch, get_store
+from throttle import CircuitOpen, Throttle
 
 
 NO_GAMETIME = datetime.datetime(2000, 1, 1, tzinfo=pytz.timezone("America/Chicago"))
-TABLES = {
-    'leagues': 'commander.leagues',
-    'teams': 'commander.teams',
-    'projections': 'commander.projections',
-    'scores': 'commander.scores',
-    'matchups': 'commander.matchups',
-    'game_progress': 'commander.game_progress',
-    'changes': 'commander.changes',
-}
+PROFILE_TTL = int(os.environ.get('COMMANDER_PROFILE_TTL', 300))
+INGEST_WORKERS = int(os.environ.get('COMMANDER_INGEST_WORKERS', 8))
+LEAGUE_TTL = int(os.environ.get('COMMANDER_LEAGUE_TTL', 21600))
+FULL_REFRESH_INTERVAL = int(os.environ.get('COMMANDER_FULL_REFRESH_INTERVAL', 600))
+RECORD_SIZE = 3
+SLEEPER_PLAYERS_TTL = 86400
+SLEEPER_PLAYERS_RETRY = 900
+SLEEPER_PLAYER_FIELDS = ('full_name', 'last_name', 'team', 'injury_status', 'fantasy_positions')
+ESPN_ERRORS = (ESPNAccessDenied, ESPNInvalidLeague, ESPNUnknownError, requests.RequestException)
+ESPN = Throttle(
+    rate=float(os.environ.get('COMMANDER_ESPN_RATE', 5)),
+    burst=int(os.environ.get('COMMANDER_ESPN_BURST', 10)),
+    concurrency=int(os.environ.get('COMMANDER_ESPN_CONCURRENCY', 4)),
+    retries=int(os.environ.get('COMMANDER_ESPN_RETRIES', 4)),
+    retry_on=ESPN_ERRORS,
+    retryable=lambda e: espn_retryable(e),
+)
+# Upstream base URLs, kept here so a benchmark or local stub can point them elsewhere
+SLEEPER_URL = 'https://api.sleeper.app/v1'
+FANTASYPROS_URL = 'https://www.fantasypros.com'
+ESPN_API_URL = 'https://lm-api-reads.fantasy.espn.com/apis/v3/games/ffl'
+ESPN_CDN_URL = 'https://cdn.espn.com'
+ECR_DATA = re.compile(r'var ecrData = (\{.*?\});\s*$', re.MULTILINE)
+
+# ESPN requests are already retried by the ESPN throttle
+for base in (ESPN_API_URL, ESPN_CDN_URL):
+    http_client.configure(urlsplit(base).netloc, retries=0)
+
+# espn_api calls requests.get without a timeout, so one hung connection would hold its ESPN slot, and the update
+# holding the ingest lock, forever. Its League and box score reads go through http_client's timeouts and pools instead
+espn_requests.requests = types.SimpleNamespace(get=http_client.get)
+
+_profiles = {'loaded': None, 'profiles': {}, 'leagues': {}}
+_profiles_lock = threading.Lock()
+_espn_leagues = {}
+_espn_leagues_lock = threading.Lock()
+_espn_league_locks = {}
+_query_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='query')
+_sleeper_players = {'loaded': None, 'retry': 0, 'players': {}}
+_sleeper_players_lock = threading.Lock()
+_projection_pages = {}
+_scores_snapshot = {'week': None, 'rows': {}, 'matchups': set()}
+_scores_snapshot_lock = threading.Lock()
+_league_refreshed = {}
+_gametimes = {'week': None, 'teams': {}}
+_gametimes_lock = threading.Lock()
+_leaderboards = {}
+_leaderboards_lock = threading.Lock()
+_projection_pages_lock = threading.Lock()
+
+
+def load_profiles(refresh: bool = False) -> dict:
+    profiles = _cached_profiles(refresh).get('profiles')
+    return {profile: [dict(league) for league in leagues] for profile, leagues in profiles.items()}
+
+
+def get_league_profile(league_id: int) -> dict:
+    league = _cached_profiles().get('leagues').get(league_id)
+    return dict(league) if league else {}
+
+
+def invalidate_profiles():
+    with _profiles_lock:
+        _profiles['loaded'] = None
+
+
+def _cached_profiles(refresh: bool = False) -> dict:
+    """ Reads the leagues table at most once per PROFILE_TTL seconds, indexing each league_id to its credentials """
+
+    with _profiles_lock:
+
+        if not refresh and _profiles.get('loaded') is not None and time.monotonic() - _profiles.get('loaded') < PROFILE_TTL:
+            return _profiles
+
+        profiles = {}
+        leagues = {}
+
+        for league in get_store().select('leagues', order_by=['platform', 'league_id']):
+
+            if league.profile not in profiles.keys():
+                profiles[league.profile] = []
+
+            profiles[league.profile].append({
+                'name': league.name,
+                'platform': league.platform,
+                'scoring': league.scoring,
+                'league_id': league.league_id,
+                'team_id': league.team_id,
+                'start_year': league.start_year,
+                'swid': league.swid,
+                's2': league.s2,
+            })
+
+            if league.league_id not in leagues.keys() or not leagues.get(league.league_id).get('s2'):
+                leagues[league.league_id] = profiles[league.profile][-1]
+
+        _profiles.update({'loaded': time.monotonic(), 'profiles': profiles, 'leagues': leagues})
+
+        return _profiles
 
 
-def initialize_bigquery_client():
-    return bigquery.Client()
+def initialize_espn_league(league_id: int, year: int) -> League:
+    league = get_league_profile(league_id)
+    return ESPN.call(League, league_id=league_id, year=year, espn_s2=league.get('s2'), swid=league.get('swid'))
 
 
-def run_query(query: str, as_list: bool = False):
-    if not as_list:
-        return bigquery.Client().query(query).result()
-    else:
-        return [row for row in bigquery.Client().query(query).result()]
+def get_espn_league(league_id: int, year: int) -> League:
+    """
+    League objects are kept per (league_id, year) and rebuilt only after LEAGUE_TTL, so a refresh cycle only pays for
+    box_scores instead of re-downloading settings, teams and the player map
+    """
 
+    key = (league_id, year)
 
-def write_to_bigquery(table: str, schema: list, rows: list):
+    with _espn_leagues_lock:
+        entry = _espn_leagues.get(key)
+        if entry and time.monotonic() - entry.get('loaded') < LEAGUE_TTL:
+            return entry.get('league')
+        lock = _espn_league_locks.setdefault(key, threading.Lock())
 
-    bq = bigquery.Client()
+    # One build per key at a time; callers waiting on it pick up the fresh League
+    with lock:
 
-    job_config = bigquery.LoadJobConfig(schema=schema, source_format='NEWLINE_DELIMITED_JSON')
-    bq.load_table_from_json(rows, table, job_config=job_config).result()
+        with _espn_leagues_lock:
+            entry = _espn_leagues.get(key)
+            if entry and time.monotonic() - entry.get('loaded') < LEAGUE_TTL:
+                return entry.get('league')
 
+        league = initialize_espn_league(league_id, year)
 
-def load_profiles() -> dict:
+        with _espn_leagues_lock:
+            _espn_leagues[key] = {'league': league, 'loaded': time.monotonic()}
 
-    profiles = {}
-    bq = bigquery.Client()
+    return league
 
-    for league in [league for league in bq.query(f"SELECT * FROM `{TABLES.get('leagues')}` ORDER BY platform, league_id").result()]:
 
-        if league.profile not in profiles.keys():
-            profiles[league.profile] = []
+def espn_retryable(error: Exception) -> bool:
+    """
+    Only connection errors, timeouts, 429 and 5xx; bad credentials, private or missing leagues fail straight away.
+    espn_api raises ESPNUnknownError for any other status it gets, which is mostly 429 and 5xx
+    """
 
-        profiles[league.profile].append({
-            'name': league.name,
-            'platform': league.platform,
-            'scoring': league.scoring,
-            'league_id': league.league_id,
-            'team_id': league.team_id,
-            'start_year': league.start_year,
-            'swid': league.swid,
-            's2': league.s2,
-        })
-    
-    return profiles
+    if isinstance(error, ESPNUnknownError):
+        return True
 
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status == 429 or (status or 0) >= 500
 
-def initialize_espn_league(league_id: int, year: int) -> League:
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
 
-    s2 = swid = None
-    profiles = load_profiles()
 
-    for profile, leagues in profiles.items():
-        for league in leagues:
-            if league.get('league_id') == league_id:
-                s2, swid = league.get('s2'), league.get('swid')
+def espn_get(url: str, **kwargs) -> dict:
 
-    return League(league_id=league_id, year=year, espn_s2=s2, swid=swid)
+    def get():
+        response = http_client.get(url, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    return ESPN.call(get)
 
 
 def get_current_week() -> int:
@@ -102,331 +213,591 @@ def player_sort(item: dict) -> tuple:
         return 0
 
 
-def translate_team(input: str, output: str, team_name: str) -> str:
+def projection_pages(week: int) -> dict:
+    """ {url: (position, [scoring formats it serves])} for every FantasyPros rankings page a week needs """
 
-    teams = [
-        {'espn': 'WSH', 'sleeper': 'WAS', 'fp': 'WAS', 'nfl': 'WSH'},
-        {'espn': 'JAX', 'sleeper': 'JAX', 'fp': 'JAC', 'nfl': 'JAX'},
-        {'espn': 'OAK', 'sleeper': 'LV', 'fp': 'LV', 'nfl': 'LV'},
-    ]
+    pages = {}
 
-    if not team_name:
-        return ''
+    for position_name in ['qb', 'rb', 'wr', 'te', 'k', 'dst']:
+        for scoring in projection_changes.FORMATS:
 
-    for team in teams:
-        if team.get(input) == team_name:
-            return team.get(output)
-    
-    return team_name
+            # Standard rankings have no scoring prefix
+            if position_name in ['qb', 'k', 'dst'] or scoring == 'standard':
+                url = f"{FANTASYPROS_URL}/nfl/rankings/{position_name}.php?week={week}"
+            else:
+                url = f"{FANTASYPROS_URL}/nfl/rankings/{scoring}-{position_name}.php?week={week}"
+
+            # QB, K and DST rankings don't depend on scoring, so one page serves every format
+            pages.setdefault(url, (position_name, []))[1].append(scoring)
 
+    return pages
 
-def get_all_projections(week: int = get_current_week()) -> dict:
 
-    runtime = datetime.datetime.utcnow()
+def parse_projections(pages: dict, payloads: dict, empty: set = None) -> dict:
+    """ With an empty set, also adds the (position, scoring) pairs whose page came back without any players """
 
     projections = {}
+    index = identity.load_index()
 
-    for position_name in ['qb', 'rb', 'wr', 'te', 'k', 'dst']:
-        for scoring in ['half-point-ppr', 'ppr']:
+    for url, (position_name, scorings) in pages.items():
 
-            if position_name in ['qb', 'k', 'dst']:
-                url = f"https://www.fantasypros.com/nfl/rankings/{position_name}.php?week={week}"
-            else:
-                url = f"https://www.fantasypros.com/nfl/rankings/{scoring}-{position_name}.php?week={week}"
+        if empty is not None and not payloads.get(url).get('players'):
+            empty.update((position_name.upper(), scoring) for scoring in scorings)
 
-            for line in BeautifulSoup(requests.get(url).text, 'html.parser').find_all('script'):
-                if 'ecrData' in line.text:
+        for player in payloads.get(url).get('players', []):
 
-                    data = json.loads(line.text.split('\n')[5].split('var ecrData = ')[1].replace(';', ''))
+            if position_name != 'dst':
+                name = ' '.join(player.get('player_name').split(' ')[0:2])
+            else:
+                name = f"{player.get('player_name').split(' ')[-1]} D/ST"
+            team = player.get('player_team_id')
+            position = player.get('player_position_id')
+            projected = player.get('r2p_pts')
 
-                    for player in data.get('players'):
+            if not projected:
+                continue
 
-                        if position_name != 'dst':
-                            name = ' '.join(player.get('player_name').split(' ')[0:2])
-                        else:
-                            name = f"{player.get('player_name').split(' ')[-1]} D/ST"
-                        team = player.get('player_team_id')
-                        position = player.get('player_position_id')
-                        projected = player.get('r2p_pts')
+            if team not in projections.keys():
+                projections[team] = {}
 
-                        if not projected:
-                            continue
+            if position not in projections.get(team).keys():
+                projections[team][position] = {}
 
-                        if team not in projections.keys():
-                            projections[team] = {}
-                        
-                        if position not in projections.get(team).keys():
-                            projections[team][position] = {}
+            if name not in projections.get(team).get(position).keys():
+                projections[team][position][name] = {}
 
-                        if name not in projections.get(team).get(position).keys():
-                            projections[team][position][name] = {}
+            projections[team][position][name]['player_id'] = identity.fantasypros_player_id(index, player)
 
-                        projections[team][position][name][scoring] = float(projected)
+            for scoring in scorings:
+                projections[team][position][name][scoring] = float(projected)
 
     return projections
 
 
-def update_all_scores(week: int = get_current_week()) -> dict:
+def get_projection_page(url: str) -> dict:
+    """
+    Fetches a FantasyPros rankings page and returns its ecrData. The page goes through the HTTP cache, so an unchanged
+    page comes back as a 304, and the parsed data is kept per ETag so it is only extracted again when the page changed
+    """
 
-    runtime = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-    leagues = []
-    matchups = []
-    gametimes = {}
-    responses = []
-
-    schemas = {
-        'scores': [
-            {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "team_id",     "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "name",        "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "status",      "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "position",    "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "slot",        "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "points",      "type": "FLOAT",    "mode": "REQUIRED"},
-            {"name": "play_status", "type": "STRING",   "mode": "REQUIRED"},
-            {"name": "gametime",    "type": "DATETIME", "mode": "REQUIRED"},
-            {"name": "updated",     "type": "DATETIME", "mode": "REQUIRED"},
-        ],
-        'matchups': [
-            {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "home",        "type": "INTEGER",  "mode": "REQUIRED"},
-            {"name": "away",        "type": "INTEGER",  "mode": "REQUIRED"},
-        ],
-    }
+    with _projection_pages_lock:
+        cached = _projection_pages.get(url, {})
+
+    try:
+        with metrics.timer('projection_page', page=urlsplit(url).path):
+            response = http_client.get(url, cache=True)
+    except requests.RequestException:
+        if cached:
+            return cached.get('data')
+        raise
+
+    if not response.ok:
+        return cached.get('data', {})
+
+    etag = response.headers.get('ETag')
+
+    if etag and etag == cached.get('etag'):
+        return cached.get('data')
+
+    match = ECR_DATA.search(response.text)
+    data = json.loads(match.group(1)) if match else {}
+
+    with _projection_pages_lock:
+        _projection_pages[url] = {'etag': etag, 'data': data}
+
+    return data
+
+
+def unique_leagues() -> list:
+    """ Every league followed by any profile, once, with the first profile's settings """
+
+    leagues = {}
 
     for profile in load_profiles().values():
         for league in profile:
-            if (league.get('platform'), league.get('league_id')) not in leagues:
-                leagues.append((league.get('platform'), league.get('league_id')))
+            leagues.setdefault(league.get('league_id'), league)
 
-    for league in leagues:
+    return list(leagues.values())
 
-        platform = league[0]
-        league_id = league[1]
 
-        players = []
+def select_score_leagues(week: int, progress: dict, differential: bool = False) -> tuple:
+    """ ([ESPN league ids], [Sleeper league ids]) to refresh this cycle """
 
-        if platform == 'espn':
+    leagues = [(league.get('platform'), league.get('league_id')) for league in unique_leagues()]
 
-            league = initialize_espn_league(league_id, 2024)
+    if differential:
+        selected = select_live_leagues([league_id for platform, league_id in leagues], week, progress)
+        leagues = [league for league in leagues if league[1] in selected]
 
-            for game in league.box_scores(week):
+    return (
+        [league_id for platform, league_id in leagues if platform == 'espn'],
+        [league_id for platform, league_id in leagues if platform == 'sleeper'],
+    )
 
-                matchups.append({'league_id': league_id, 'week': week, 'home': game.home_team.team_id, 'away': game.away_team.team_id})
-                matchups.append({'league_id': league_id, 'week': week, 'home': game.away_team.team_id, 'away': game.home_team.team_id})
-                
-                for team_data, team_roster in ((game.home_team, game.home_lineup), (game.away_team, game.away_lineup)):
-                    for player_data in team_roster:
 
-                        player = {
-                            'league_id': league_id,
-                            'week': week,
-                            'team_id': team_data.team_id,
-                            'name': player_data.name,
-                            'team': player_data.proTeam,
-                            'status': player_data.injuryStatus,
-                            'position': player_data.position.replace('/', ''),
-                            'slot': player_data.slot_position.replace('/', '').replace('RBWRTE', 'FLEX'),
-                            'points': player_data.points,
-                        }
+def week_gametimes(week: int) -> dict:
+    """ {team: (gametime, gamedone)} known so far this week, from ESPN leagues refreshed in earlier cycles """
 
-                        if player.get('status') == 'NORMAL':
-                            player['status'] = 'ACTIVE'
+    with _gametimes_lock:
+        if _gametimes.get('week') != week:
+            _gametimes.update({'week': week, 'teams': {}})
+        return dict(_gametimes.get('teams'))
 
-                        if player.get('projected') == 0 and player.get('status') == 'ACTIVE':
-                            player['status'] = 'warning'
 
-                        if not hasattr(player_data, 'game_date'):
-                            player['gametime'] = NO_GAMETIME
-                            player['play_status'] = 'bye'
-                        
-                        else:
-                            player['gametime'] = player_data.game_date.astimezone(pytz.timezone('America/Chicago'))
-                            now = get_current_central_datetime()
-                            if now >= player.get('gametime'):
-                                player['play_status'] = 'played' if player_data.game_played == 100 else 'playing'
-                            elif player.get('gametime').strftime('%Y-%m-%d') == now.strftime('%Y-%m-%d'):
-                                player['play_status'] = 'today'
-                            else:
-                                player['play_status'] = 'future'
+def settle_gametimes(gametimes: dict, progress: dict):
 
-                        if player.get('gametime') and player_data.proTeam not in gametimes.keys():
-                            gametimes[player_data.proTeam] = (player.get('gametime'), player_data.game_played == 100)
+    # Game times carried over from ESPN leagues skipped this cycle may predate the final whistle
+    for team, (gametime, gamedone) in gametimes.items():
+        if not gamedone and progress.get(team, 0) >= 1:
+            gametimes[team] = (gametime, True)
 
-                        player['gametime'] = player.get('gametime').strftime('%Y-%m-%d %H:%M:%S')
-                        player['updated'] = runtime
+    with _gametimes_lock:
+        _gametimes.get('teams').update(gametimes)
 
-                        players.append(player)
 
-        if platform == 'sleeper':
+def collect_scores(league_ids: list, results, players: list, matchups: list, fetched: list, gametimes: dict = None):
+    """ Adds each league's fetch_league_scores result to the cycle's rows, skipping leagues that failed """
 
-            all_players = requests.get('https://api.sleeper.app/v1/players/nfl').json()
+    for league_id, result in zip(league_ids, results):
+        if not result:
+            continue
+        if result[0]:
+            fetched.append(league_id)
+        players.extend(result[0])
+        matchups.extend(result[1])
+        if gametimes is not None:
+            gametimes.update(result[2])
 
-            count = 0
 
-            matchup = []
-            players = []
-
-            for team in sorted(
-                requests.get(f'https://api.sleeper.app/v1/league/{league_id}/matchups/{week}').json(),
-                key=lambda x: x.get('matchup_id')):
-
-                for i in team.get('players'):
-
-                    player_data = all_players.get(i)
-
-                    if not player_data:
-                        continue
-
-                    player = {
-                        'league_id': league_id,
-                        'week': week,
-                        'team_id': team.get('roster_id'),
-                        'name': player_data.get('full_name', f"{player_data.get('last_name')} D/ST"),
-                        'team': translate_team('sleeper', 'espn', player_data.get('team')),
-                        'status': player_data.get('injury_status'),
-                        'position': player_data.get('fantasy_positions')[0].replace('DEF', 'DST'),
-                        'slot': player_data.get('fantasy_positions')[0].replace('DEF', 'DST') if i in team.get('starters') else 'BE',
-                        'points': team.get('players_points').get(i),
-                    }
-
-                    if player.get('status') == None:
-                        player['status'] = 'ACTIVE'
-
-                    if player.get('projected') == 0 and player.get('status') == 'ACTIVE':
-                        player['status'] = 'warning'
-                    
-                    gametime, gamedone = gametimes.get(translate_team('sleeper', 'espn', player_data.get('team')), (None, None))
-
-                    if not gametime or gametime == NO_GAMETIME:
-                        player['gametime'] = NO_GAMETIME
-                        player['play_status'] = 'bye'
-                    
-                    else:
-                        player['gametime'] = gametime
-                        now = get_current_central_datetime()
-                        if now >= player.get('gametime'):
-                            player['play_status'] = 'played' if gamedone else 'playing'
-                        elif player.get('gametime').strftime('%Y-%m-%d') == now.strftime('%Y-%m-%d'):
-                            player['play_status'] = 'today'
-                        else:
-                            player['play_status'] = 'future'
-
-                    player['gametime'] = player.get('gametime').strftime('%Y-%m-%d %H:%M:%S')
-                    player['updated'] = runtime
-
-                    players.append(player)
-                
-                matchup.append(team.get('roster_id'))
-
-                count += 1
-
-                if not count % 2:
-                    matchups.append({'league_id': league_id, 'week': week, 'home': matchup[0], 'away': matchup[1]})
-                    matchups.append({'league_id': league_id, 'week': week, 'home': matchup[1], 'away': matchup[0]})
-                    matchup = []
-        
-        for player in players:
-            for suffix in [' Jr.', ' III']:
-                if suffix in player.get('name'):
-                    player['name'] = player.get('name').replace(suffix, '')
-
-        if players:
-            write_to_bigquery(TABLES.get('scores'), schemas.get('scores'), players)
-            run_query(f"DELETE FROM `{TABLES.get('scores')}` WHERE league_id = {league_id} AND updated < '{runtime}'")
-    
-    if matchups:
-        run_query(f"DELETE FROM `{TABLES.get('matchups')}` WHERE week = {week}")
-        write_to_bigquery(TABLES.get('matchups'), schemas.get('matchups'), matchups)
+def commit_scores(week: int, players: list, matchups: list, fetched: list):
 
+    for player in players:
+        for suffix in [' Jr.', ' III']:
+            if suffix in player.get('name'):
+                player['name'] = player.get('name').replace(suffix, '')
 
-def get_league_data(data: dict, league: dict):
+    write_scores(week, players, matchups, fetched)
 
-    data[league.get('name')] = []
-    threads = []
+    with _scores_snapshot_lock:
+        _league_refreshed.update({league_id: time.monotonic() for league_id in fetched})
 
-    if league.get('platform') == 'espn':
 
-        for year in range(league.get('start'), datetime.datetime.utcnow().year + 1):
+def select_live_leagues(league_ids: list, week: int, progress: dict) -> list:
+    """
+    Leagues with a player whose game is live or has finished since the last refresh, plus any league that hasn't
+    been refreshed within FULL_REFRESH_INTERVAL, so lineup and injury changes elsewhere still come through
+    """
 
-            thread = threading.Thread(target=get_league_year_data, args=(data, year, league))
-            thread.start()
-            threads.append(thread)
+    now = get_current_central_datetime()
+    live = set()
 
-    for thread in threads:
-        thread.join()
+    with _scores_snapshot_lock:
+        rows = list(_scores_snapshot.get('rows').values()) if _scores_snapshot.get('week') == week else []
+        refreshed = dict(_league_refreshed)
 
+    for row in rows:
 
-def get_league_year_data(data: dict, year: int, league: dict):
+        if row.get('league_id') in live:
+            continue
 
-    threads = []
-    season = None
+        if row.get('play_status') == 'playing' or 0 < progress.get(row.get('team'), 0) < 1:
+            live.add(row.get('league_id'))
+        elif row.get('play_status') in ['today', 'future'] and parse_gametime(row.get('gametime')) <= now:
+            live.add(row.get('league_id'))
 
-    while not season:
-        try:
-            season = initialize_espn_league(league.get('id'), year)
-        except ESPNAccessDenied:
-            time.sleep(0.5)
+    return [
+        league_id for league_id in league_ids
+        if league_id in live or league_id not in refreshed or time.monotonic() - refreshed.get(league_id) > FULL_REFRESH_INTERVAL
+    ]
 
 
-    week = 1
+def get_game_progress(week: int) -> dict:
+    return {
+        translate_team('nfl', 'espn', game.team): game.progress
+        for game in get_store().select('game_progress', {'year': get_current_year(), 'week': week})
+    }
 
-    for week in range(1, 15):
-        
-        thread = threading.Thread(target=get_league_week_data, args=(data, year, week, season, league))
-        thread.start()
-        threads.append(thread)
 
-    for thread in threads:
-        thread.join()
+def parse_gametime(gametime) -> datetime.datetime:
 
+    if isinstance(gametime, str):
+        gametime = datetime.datetime.strptime(gametime, '%Y-%m-%d %H:%M:%S')
 
-def get_league_week_data(data: dict, year: int, week: int, season: League, league: dict):
+    if gametime.tzinfo is None:
+        gametime = pytz.timezone('America/Chicago').localize(gametime)
 
-    threads = []
-    matchup_data = None
+    return gametime
 
-    while not matchup_data:
-        try:
-            matchup_data = season.box_scores(week)
-        except ESPNAccessDenied:
-            time.sleep(0.5)
-    
-    if not matchup_data or matchup_data[0].is_playoff:
-        return
-        
-    if year >= datetime.datetime.utcnow().year and week >= get_current_week():
-        return
 
-    matchup_id = 0
+def fetch_league_scores(fetch, league_id: int, *args) -> tuple:
+    """ A league that can't be fetched, or comes back empty, keeps its last written scores instead of failing the whole refresh """
+    try:
+        with metrics.timer('league_scores', platform=fetch.__name__.split('_')[1]):
+            return fetch(league_id, *args)
+    except ESPN_ERRORS + (CircuitOpen,) as e:
+        print(f"scores: league {league_id} unavailable: {e!r}")
+        return None
+
+
+@metrics.timed('write_scores')
+def write_scores(week: int, players: list, matchups: list, league_ids: list):
+    """
+    Compares a cycle's rows against the last written snapshot and sends only what changed: one upsert for every
+    league's changed score rows, one delete for players no longer rostered, and the week's matchups only if they moved
+    """
+
+    store = get_store()
+
+    with _scores_snapshot_lock:
+
+        if _scores_snapshot.get('week') != week:
 
-    for matchup in matchup_data:
+            rows = {}
 
-        matchup_id += 1
+            for row in store.select('scores', {'week': week}):
+                row = dict(row)
+                if isinstance(row.get('gametime'), datetime.datetime):
+                    row['gametime'] = row.get('gametime').strftime('%Y-%m-%d %H:%M:%S')
+                rows[score_key(row)] = row
 
-        for team in (
-            (matchup.home_team, matchup.home_score, matchup.home_projected),
-            (matchup.away_team, matchup.away_score, matchup.away_projected)
-        ):
+            _scores_snapshot.update({
+                'week': week,
+                'rows': rows,
+                'matchups': {(m.league_id, m.week, m.home, m.away) for m in store.select('matchups', {'week': week})},
+            })
 
-            if team[1] == 0:
+        snapshot = _scores_snapshot.get('rows')
+        current = {score_key(player): player for player in players}
+
+        changed = [player for key, player in current.items() if score_changed(snapshot.get(key), player)]
+        removed = [key for key in snapshot.keys() if key[0] in league_ids and key not in current.keys()]
+
+        store.upsert('scores', changed)
+        store.delete_keys('scores', removed)
+
+        for key in removed:
+            del snapshot[key]
+
+        snapshot.update({score_key(player): player for player in changed})
+
+        fetched = {m for m in _scores_snapshot.get('matchups') if m[0] not in league_ids}
+        fetched.update((m.get('league_id'), m.get('week'), m.get('home'), m.get('away')) for m in matchups)
+
+        if fetched != _scores_snapshot.get('matchups'):
+            store.delete('matchups', {'week': week})
+            store.write('matchups', [dict(zip(('league_id', 'week', 'home', 'away'), m)) for m in sorted(fetched)])
+            _scores_snapshot['matchups'] = fetched
+
+
+def score_key(player: dict) -> tuple:
+    return player.get('league_id'), player.get('team_id'), player.get('week'), player.get('name')
+
+
+def score_changed(old: dict, new: dict) -> bool:
+    return not old or any(old.get(field) != new.get(field) for field in new.keys() if field != 'updated')
+
+
+def get_espn_scores(league_id: int, week: int, runtime: str) -> tuple:
+
+    players = []
+    matchups = []
+    gametimes = {}
+
+    league = get_espn_league(league_id, 2024)
+    index = identity.load_index()
+
+    for game in ESPN.call(league.box_scores, week):
+
+        matchups.append({'league_id': league_id, 'week': week, 'home': game.home_team.team_id, 'away': game.away_team.team_id})
+        matchups.append({'league_id': league_id, 'week': week, 'home': game.away_team.team_id, 'away': game.home_team.team_id})
+
+        for team_data, team_roster in ((game.home_team, game.home_lineup), (game.away_team, game.away_lineup)):
+            for player_data in team_roster:
+
+                player = {
+                    'league_id': league_id,
+                    'week': week,
+                    'team_id': team_data.team_id,
+                    'name': player_data.name,
+                    'team': player_data.proTeam,
+                    'status': player_data.injuryStatus,
+                    'position': player_data.position.replace('/', ''),
+                    'slot': player_data.slot_position.replace('/', '').replace('RBWRTE', 'FLEX'),
+                    'points': player_data.points,
+                }
+
+                player['player_id'] = identity.espn_player_id(index, player_data.playerId, player.get('name'), player.get('team'), player.get('position'))
+
+                if player.get('status') == 'NORMAL':
+                    player['status'] = 'ACTIVE'
+
+                if player.get('projected') == 0 and player.get('status') == 'ACTIVE':
+                    player['status'] = 'warning'
+
+                if not hasattr(player_data, 'game_date'):
+                    player['gametime'] = NO_GAMETIME
+                    player['play_status'] = 'bye'
+
+                else:
+                    player['gametime'] = player_data.game_date.astimezone(pytz.timezone('America/Chicago'))
+                    now = get_current_central_datetime()
+                    if now >= player.get('gametime'):
+                        player['play_status'] = 'played' if player_data.game_played == 100 else 'playing'
+                    elif player.get('gametime').strftime('%Y-%m-%d') == now.strftime('%Y-%m-%d'):
+                        player['play_status'] = 'today'
+                    else:
+                        player['play_status'] = 'future'
+
+                if player.get('gametime') and player_data.proTeam not in gametimes.keys():
+                    gametimes[player_data.proTeam] = (player.get('gametime'), player_data.game_played == 100)
+
+                player['gametime'] = player.get('gametime').strftime('%Y-%m-%d %H:%M:%S')
+                player['updated'] = runtime
+
+                players.append(player)
+
+    return players, matchups, gametimes
+
+
+def fetch_sleeper_matchups(league_id: int, week: int) -> list:
+    return sleeper_get(f'{SLEEPER_URL}/league/{league_id}/matchups/{week}')
+
+
+def sleeper_get(url: str):
+    return http_client.get(url).json()
+
+
+def build_sleeper_scores(league_id: int, week: int, runtime: str, gametimes: dict, teams: list) -> tuple:
+    """ Score rows and matchups from a league's Sleeper matchups payload, with game times taken from ESPN's """
+
+    players = []
+    matchups = []
+
+    all_players = load_sleeper_players()
+
+    count = 0
+
+    matchup = []
+
+    for team in sorted(teams, key=lambda x: x.get('matchup_id')):
+
+        for i in team.get('players'):
+
+            if i not in all_players:
                 continue
 
-            owner = "Redacted" if team[0].owner == "None" else team[0].owner
+            player_data = {field: value for field, value in zip(SLEEPER_PLAYER_FIELDS, all_players.get(i)) if value is not None}
+
+            player = {
+                'league_id': league_id,
+                'week': week,
+                'team_id': team.get('roster_id'),
+                'name': player_data.get('full_name', f"{player_data.get('last_name')} D/ST"),
+                'team': translate_team('sleeper', 'espn', player_data.get('team')),
+                'status': player_data.get('injury_status'),
+                'position': player_data.get('fantasy_positions')[0].replace('DEF', 'DST'),
+                'slot': player_data.get('fantasy_positions')[0].replace('DEF', 'DST') if i in team.get('starters') else 'BE',
+                'points': team.get('players_points').get(i),
+                'player_id': identity.sleeper_player_id(i, player_data.get('team')),
+            }
+
+            if player.get('status') == None:
+                player['status'] = 'ACTIVE'
+
+            if player.get('projected') == 0 and player.get('status') == 'ACTIVE':
+                player['status'] = 'warning'
+
+            gametime, gamedone = gametimes.get(translate_team('sleeper', 'espn', player_data.get('team')), (None, None))
+
+            if not gametime or gametime == NO_GAMETIME:
+                player['gametime'] = NO_GAMETIME
+                player['play_status'] = 'bye'
+
+            else:
+                player['gametime'] = gametime
+                now = get_current_central_datetime()
+                if now >= player.get('gametime'):
+                    player['play_status'] = 'played' if gamedone else 'playing'
+                elif player.get('gametime').strftime('%Y-%m-%d') == now.strftime('%Y-%m-%d'):
+                    player['play_status'] = 'today'
+                else:
+                    player['play_status'] = 'future'
+
+            player['gametime'] = player.get('gametime').strftime('%Y-%m-%d %H:%M:%S')
+            player['updated'] = runtime
+
+            players.append(player)
+
+        matchup.append(team.get('roster_id'))
+
+        count += 1
+
+        if not count % 2:
+            matchups.append({'league_id': league_id, 'week': week, 'home': matchup[0], 'away': matchup[1]})
+            matchups.append({'league_id': league_id, 'week': week, 'home': matchup[1], 'away': matchup[0]})
+            matchup = []
+
+    return players, matchups
+
+
+def load_sleeper_players() -> dict:
+    """
+    Sleeper's NFL player list is several megabytes, so it is fetched at most once per SLEEPER_PLAYERS_TTL and kept
+    on disk and in memory as {player_id: tuple of SLEEPER_PLAYER_FIELDS}. The player identity index is rebuilt from
+    the same download. After a failed download the stale copy is used for SLEEPER_PLAYERS_RETRY before trying again.
+    """
+
+    path = os.path.join(DATA_DIR, 'sleeper_players.json.gz')
+
+    with _sleeper_players_lock:
+
+        if _sleeper_players.get('loaded') and time.time() - _sleeper_players.get('loaded') < SLEEPER_PLAYERS_TTL:
+            return _sleeper_players.get('players')
+
+        if _sleeper_players.get('players') and time.time() < _sleeper_players.get('retry'):
+            return _sleeper_players.get('players')
+
+        stale = not os.path.exists(path) or time.time() - os.path.getmtime(path) >= SLEEPER_PLAYERS_TTL
+
+        if stale or not os.path.exists(identity.INDEX_PATH):
+            try:
+                players = http_client.get(f'{SLEEPER_URL}/players/nfl').json()
+                compact = {i: [player.get(field) for field in SLEEPER_PLAYER_FIELDS] for i, player in players.items()}
+                os.makedirs(DATA_DIR, exist_ok=True)
+                with gzip.open(f"{path}.tmp", 'wt') as f:
+                    json.dump(compact, f, separators=(',', ':'))
+                os.replace(f"{path}.tmp", path)
+                identity.save_index(identity.build_index(players))
+            except (requests.RequestException, ValueError) as e:
+                _sleeper_players['retry'] = time.time() + SLEEPER_PLAYERS_RETRY
+                if not os.path.exists(path):
+                    raise
+                print(f"sleeper players: keeping the stale copy: {e!r}")
+
+        with gzip.open(path, 'rt') as f:
+            players = {i: tuple(fields) for i, fields in json.load(f).items()}
+
+        _sleeper_players.update({'loaded': os.path.getmtime(path), 'players': players})
+
+        return players
+
+
+def get_league_records(league: dict, batch: Batch = None) -> dict:
+    """
+    Records come from the league's Leaderboard, built from the history table on first use. Only weeks the season
+    has moved past that aren't known yet are fetched from ESPN, stored, and added to it. With a batch, the new history rows are
+    left for the caller to commit together with other leagues'.
+    """
+
+    if league.get('platform') != 'espn':
+        return {}
+
+    with _leaderboards_lock:
+        board = _leaderboards.get(league.get('id'))
 
-            data[league.get('name')].append(
-                (year, week, matchup_id, owner, round(team[1], 2), round(team[2], 2), round(team[1] - team[2], 2))
-            )
+    if board is None:
+        board = Leaderboard(RECORD_SIZE)
+        board.add_rows([dict(row) for row in get_store().select('history', {'league_id': league.get('id')})])
+        with _leaderboards_lock:
+            board = _leaderboards.setdefault(league.get('id'), board)
+
+    rows = []
+    missing = {}
+
+    for year in range(league.get('start'), datetime.datetime.utcnow().year + 1):
+        for week in range(1, 15):
+            if (year, week) not in board.weeks:
+                missing.setdefault(year, []).append(week)
+
+    if missing:
+
+        with ThreadPoolExecutor(max_workers=ESPN.concurrency, thread_name_prefix='history') as pool:
+
+            seasons = dict(zip(missing.keys(), pool.map(lambda year: get_league_season(league.get('id'), year), missing.keys())))
+            tasks = [
+                (year, week, seasons.get(year))
+                for year, weeks in missing.items() if seasons.get(year)
+                for week in weeks if is_completed_week(seasons.get(year), week)
+            ]
+
+            for week_rows in pool.map(lambda task: get_league_week_data(task[0], task[1], task[2], league), tasks):
+                rows.extend(week_rows)
+
+    if rows:
+        (batch or get_store()).upsert('history', rows)
+        board.add_rows(rows)
+
+    return board.records()
+
+
+def is_completed_week(season: League, week: int) -> bool:
+    """ ESPN's current scoring period is the one being played, or the final one once the season is over """
+    return week < season.current_week
+
+
+def get_league_season(league_id: int, year: int) -> League:
+    try:
+        return get_espn_league(league_id, year)
+    except ESPN_ERRORS + (CircuitOpen,) as e:
+        print(f"history: league {league_id} {year} unavailable: {e!r}")
+        return None
+
+
+def get_league_week_data(year: int, week: int, season: League, league: dict) -> list:
+
+    rows = []
+
+    try:
+        matchup_data = ESPN.call(season.box_scores, week)
+    except ESPN_ERRORS + (CircuitOpen,) as e:
+        # Left out of the history, so it's fetched again on the next view
+        print(f"history: league {league.get('id')} {year} week {week} unavailable: {e!r}")
+        return []
+
+    if matchup_data and not matchup_data[0].is_playoff:
+
+        matchup_id = 0
+
+        for matchup in matchup_data:
+
+            matchup_id += 1
+
+            for team in (
+                (matchup.home_team, matchup.home_score, matchup.home_projected),
+                (matchup.away_team, matchup.away_score, matchup.away_projected)
+            ):
+
+                if team[1] == 0:
+                    continue
+
+                rows.append({
+                    'league_id': league.get('id'),
+                    'year': year,
+                    'week': week,
+                    'matchup_id': matchup_id,
+                    'team_id': team[0].team_id,
+                    'owner': "Redacted" if team[0].owner == "None" else team[0].owner,
+                    'score': round(team[1], 2),
+                    'projected': round(team[2], 2),
+                    'diff': round(team[1] - team[2], 2),
+                })
+
+    # Only weeks that are over get here, so one without regular season results is recorded and not fetched again
+    if not rows:
+        rows.append({
+            'league_id': league.get('id'), 'year': year, 'week': week, 'matchup_id': 0, 'team_id': 0,
+            'owner': '', 'score': 0, 'projected': 0, 'diff': 0,
+        })
+
+    return rows
 
 
 def cleanup(text: str) -> str:
     return ' '.join(c.capitalize() for c in text.split()).strip().replace('  ', ' ')
 
 
-def organize_team(players: list, mode: str = 'default', flex_count = 1) -> dict:
+@metrics.timed('organize_team')
+def organize_team(players: list, mode: str = 'default', slots: dict = None) -> dict:
 
     team = {'starters': [], 'bench': [], 'points': 0, 'projected': 0}
 
@@ -444,38 +815,16 @@ def organize_team(players: list, mode: str = 'default', flex_count = 1) -> dict:
     team['show'] = []
 
     if mode == 'max':
-    
-        ordered_players = sorted(team.get('starters') + team.get('bench'), key=lambda x: x.get('projected', 0), reverse=True)
 
-        for position in ['QB', 'RB', 'WR', 'TE', 'FLEX', 'DST', 'K']:
-            if position != 'FLEX':
-                team['show'].append((position, [p for p in ordered_players if p.get('position') == position][0]))
+        team['show'] = optimal_lineup(team.get('starters') + team.get('bench'), slots or DEFAULT_SLOTS)
 
-            else:
-                for p in ordered_players:
-                    if p.get('position') in ['RB', 'WR', 'TE'] and p not in [op[1] for op in team.get('show')]:
-                        team['show'].append((position, p))
-                        break
-
-            if position in ['RB', 'WR']:
-                team['show'].append((position, [p for p in ordered_players if p.get('position') == position][1]))
-
-            if flex_count == 2 and position == 'FLEX':
-                for p in ordered_players:
-                    if p.get('position') in ['RB', 'WR', 'TE'] and p not in [op[1] for op in team.get('show')]:
-                        team['show'].append((position, p))
-                        break
-        
-        team['show'] = [p[1] for p in team.get('show')]
-    
     elif mode == 'default':
 
         team['show'] = team.get('starters')
     
     elif mode == 'all':
     
-        team['show'] = team.get('starters')
-        team['show'].extend(team.get('bench'))
+        team['show'] = team.get('starters') + team.get('bench')
 
     for player in team.get('show'):
         team['points'] += player.get('points')
@@ -486,28 +835,38 @@ def organize_team(players: list, mode: str = 'default', flex_count = 1) -> dict:
     return team
 
 
+@metrics.timed('get_all_matchups')
 def get_all_matchups(profile_name: str, week: int, mode: str = 'default') -> list:
 
-    runtime = datetime.datetime.utcnow()
-
     leagues = load_profiles().get(profile_name)
     matchups = []
 
     if not leagues:
         return []
 
-    score_query = f"SELECT * EXCEPT (_rn) FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY league_id, team_id, week, name ORDER BY updated DESC) AS _rn " \
-                  f"FROM `{TABLES.get('scores')}`) WHERE week = {week}"
+    store = get_store()
+    league_ids = sorted({league.get('league_id') for league in leagues})
 
-    dbs = {
-        'matchups': run_query(f"SELECT * FROM `{TABLES.get('matchups')}` WHERE week = {week}", as_list=True),
-        'teams': run_query(f"SELECT * FROM `{TABLES.get('teams')}`", as_list=True),
-        'projections': run_query(f"SELECT * FROM `{TABLES.get('projections')}` WHERE week = {week}", as_list=True),
-        'scores': run_query(score_query, as_list=True),
-        'game_progress': run_query(f"SELECT * FROM `{TABLES.get('game_progress')}` WHERE week = {week}", as_list=True),
+    queries = {
+        'matchups': ('matchups', {'week': week, 'league_id': league_ids}),
+        'teams': ('teams', {'league_id': league_ids}),
+        'projections': ('projections', {'week': week}),
+        'scores': ('scores', {'week': week, 'league_id': league_ids}),
+        'game_progress': ('game_progress', {'week': week}),
+        'slots': ('slots', {'league_id': league_ids}),
     }
 
+    def select(name: str, table: str, filters: dict) -> list:
+        with metrics.timer('query', table=name):
+            return store.select(table, filters)
+
+    futures = {name: metrics.submit(_query_pool, select, name, *query) for name, query in queries.items()}
+    dbs = {name: future.result() for name, future in futures.items()}
+
+    start = time.perf_counter()
+
     projections = {}
+    projections_by_id = {}
 
     for projection in dbs.get('projections'):
 
@@ -523,8 +882,12 @@ def get_all_matchups(profile_name: str, week: int, mode: str = 'default') -> lis
             'half-point-ppr': projection.get('half-point-ppr'),
             'ppr': projection.get('ppr')
         }
+
+        if projection.get('player_id') is not None:
+            projections_by_id[projection.get('player_id')] = projections[projection.get('team')][projection.get('player')]
     
     dbs['projections'] = projections
+    dbs['projections_by_id'] = projections_by_id
 
     progress = {}
 
@@ -541,45 +904,58 @@ def get_all_matchups(profile_name: str, week: int, mode: str = 'default') -> lis
     
     dbs['progress'] = progress
 
-    print(f"db load: {(datetime.datetime.utcnow() - runtime).seconds}s")
+    dbs['matchups'] = {(matchup.league_id, matchup.home): matchup.away for matchup in dbs.get('matchups')}
+    dbs['teams'] = {(team.league_id, team.team_id): team for team in dbs.get('teams')}
+
+    slots = {}
+
+    for slot in dbs.get('slots'):
+        slots.setdefault(slot.league_id, {})[slot.slot] = slot.count
+
+    dbs['slots'] = slots
+
+    scores = {}
+
+    for score in dbs.get('scores'):
+        scores.setdefault((score.league_id, score.team_id), []).append(score)
+
+    dbs['scores'] = scores
+
+    metrics.observe('assemble', time.perf_counter() - start)
 
     for league in leagues:
 
         league_id = league.get('league_id')
 
-        home = {'id': league.get('team_id'), 'players': []}
-        away = {'id': 0, 'players': []}
-
-        for matchup in dbs.get('matchups'):
-            if matchup.league_id == league_id and matchup.home == home.get('id'):
-                away['id'] = matchup.away
-                break
+        home = {'league_id': league_id, 'id': league.get('team_id'), 'players': []}
+        away = {'league_id': league_id, 'id': dbs.get('matchups').get((league_id, league.get('team_id')), 0), 'players': []}
 
-        for team in dbs.get('teams'):
-            if team.league_id == league_id and team.team_id == home.get('id'):
-                home['team'] = team.team
-                home['owner'] = team.owner
-            elif team.league_id == league_id and team.team_id == away.get('id'):
-                away['team'] = team.team
-                away['owner'] = team.owner
+        for side in (home, away):
 
-        for score in dbs.get('scores'):
+            team = dbs.get('teams').get((league_id, side.get('id')))
 
-            score = dict(score)
+            if team:
+                side['team'] = team.team
+                side['owner'] = team.owner
 
-            if score.get('league_id') == league_id and score.get('team_id') == home.get('id'):
-                projected = dbs.get('projections').get(score.get('team'), {}).get(score.get('name'), {}).get(league.get('scoring'), 0)
+            for score in dbs.get('scores').get((league_id, side.get('id')), []):
+                score = dict(score)
+                # Players are joined on their canonical id; rows without one fall back to team and name
+                scoring = dbs.get('projections_by_id').get(score.get('player_id')) or dbs.get('projections').get(score.get('team'), {}).get(score.get('name'), {})
+                projected = scoring.get(league.get('scoring'), 0)
+                score['projection'] = projected
+                score['remaining'] = remaining_fraction(score, progress.get(score.get('team')))
                 score['projected'] = calculate_projected(score, projected, progress.get(score.get('team')))
-                home['players'].append(score)
-            elif score.get('league_id') == league_id and score.get('team_id') == away.get('id'):
-                projected = dbs.get('projections').get(score.get('team'), {}).get(score.get('name'), {}).get(league.get('scoring'), 0)
-                score['projected'] = calculate_projected(score, projected, progress.get(score.get('team')))
-                away['players'].append(score)
+                side['players'].append(score)
+
+        slots = dbs.get('slots').get(league_id)
 
-        flex_count = 2 if league.get('platform') == 'sleeper' else 1
+        # Leagues whose settings haven't been loaded yet keep the old fixed lineup, with Sleeper's second FLEX
+        if not slots:
+            slots = dict(DEFAULT_SLOTS, FLEX=2 if league.get('platform') == 'sleeper' else 1)
 
-        home['players'] = organize_team(home.get('players'), mode, flex_count)
-        away['players'] = organize_team(away.get('players'), mode, flex_count)
+        home['players'] = organize_team(home.get('players'), mode, slots)
+        away['players'] = organize_team(away.get('players'), mode, slots)
 
         home['players']['winning_points'] = 'winning' if home.get('players').get('points') > away.get('players').get('points') else 'losing'
         away['players']['winning_points'] = 'winning' if away.get('players').get('points') > home.get('players').get('points') else 'losing'
@@ -587,171 +963,168 @@ def get_all_matchups(profile_name: str, week: int, mode: str = 'default') -> lis
         home['players']['winning_projected'] = 'winning' if home.get('players').get('projected') > away.get('players').get('projected') else 'losing'
         away['players']['winning_projected'] = 'winning' if away.get('players').get('projected') > home.get('players').get('projected') else 'losing'
 
-        home_chance = 1 / (1 + math.exp((away.get('players').get('points') - home.get('players').get('points')) / 400))
-        away_chance = 1 / (1 + math.exp((home.get('players').get('points') - away.get('players').get('points')) / 400))
+        matchups.append({'home': home, 'away': away})
 
-        home['players']['win_chance'] = f"{round(100 * home_chance)}%"
-        away['players']['win_chance'] = f"{round(100 * away_chance)}%"
+    set_win_chances(matchups, mode)
 
-        home['players']['win_chance'] = ""
-        away['players']['win_chance'] = ""
+    return matchups
 
-        matchups.append({'home': home, 'away': away})
 
-    return matchups
+@metrics.timed('win_chances')
+def set_win_chances(matchups: list, mode: str):
+    """ Simulates every matchup on the page together; max mode counts the optimal lineup, other modes the starters """
+
+    teams = []
 
+    for matchup in matchups:
+        for side in (matchup.get('home'), matchup.get('away')):
+            counted = side.get('players').get('show' if mode == 'max' else 'starters')
+            teams.append([(p.get('points'), p.get('projection'), p.get('remaining'), p.get('position')) for p in counted])
 
-def update_projections(week: int = get_current_week()):
+    chances = winprob.win_probabilities(teams, [(i, i + 1) for i in range(0, len(teams), 2)])
 
-    runtime = get_current_central_datetime().strftime('%Y-%m-%d %H:%M:%S')
+    for matchup, chance in zip(matchups, chances):
+        matchup.get('home').get('players')['win_chance'] = f"{round(100 * chance)}%"
+        matchup.get('away').get('players')['win_chance'] = f"{round(100 * (1 - chance))}%"
+
+
+def build_projections(week: int, projections: dict, runtime: str, empty: set = ()) -> tuple:
+    """
+    (projection rows, change records, snapshot) for a week's projections, diffed against the previous snapshot.
+    Formats whose rankings page came back empty keep their previous projections.
+    """
+
+    players = projection_changes.snapshot(projections)
+    changes = projection_changes.detect(week, players, runtime, empty)
     rows = []
-    changes = []
-    responses = []
-
-    old_projections = run_query(f"SELECT * FROM `{TABLES.get('projections')}` WHERE week = {week}")
-    projections = get_all_projections(week)
-
-    projections_np = {}
-
-    remove_positions = []
-
-    for team, team_data in projections.items():
-        projections_np[team] = {}
-        for position, position_data in team_data.items():
-            if position not in remove_positions:
-                remove_positions.append(position)
-            for player_name, player_data in position_data.items():
-                projections_np[team][player_name] = player_data
-
-    for player in old_projections:
-        player = dict(player)
-        old = {'half-point-ppr': player.get('half-point-ppr'), 'ppr': player.get('ppr')}
-        new = projections_np.get(player.get('team'), {}).get(player.get('player'), {})
-        if old.get('ppr') != new.get('ppr'):
-            if abs(old.get('ppr', 0) - new.get('ppr', 0)) > 3:
-                changes.append({
-                    'player': player.get('player'),
-                    'team': player.get('team'),
-                    'scoring': 'ppr',
-                    'old': old.get('ppr', 0),
-                    'new': new.get('ppr', 0),
-                    'updated': runtime,
-                })
 
-    for team, team_data in projections.items():
-        for position in team_data.values():
-            for player, scoring in position.items():
-                row = {
-                    'player': player,
-                    'team': team,
-                    'week': week,
-                    'standard': 0,
-                    'half-point-ppr': scoring.get('half-point-ppr', 0),
-                    'ppr': scoring.get('ppr', 0),
-                    'updated': runtime,
-                }
-                rows.append(row)
-
-    schema = [
-        {"name": "player",          "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "team",            "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "week",            "type": "INTEGER",  "mode": "REQUIRED"},
-        {"name": "standard",        "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "half-point-ppr",  "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "ppr",             "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "updated",         "type": "DATETIME", "mode": "REQUIRED"},
-    ]
+    for player in players.values():
+        rows.append({
+            'player': player.get('player'),
+            'player_id': player.get('player_id'),
+            'team': player.get('team'),
+            'position': player.get('position'),
+            'week': week,
+            'standard': player.get('standard'),
+            'half-point-ppr': player.get('half-point-ppr'),
+            'ppr': player.get('ppr'),
+            'updated': runtime,
+        })
 
-    write_to_bigquery(TABLES.get('projections'), schema, rows)
-    run_query(f"DELETE FROM `{TABLES.get('projections')}` WHERE week = {week} AND updated < '{runtime}'")
+    return rows, changes, players
 
-    schema = [
-        {"name": "player",          "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "team",            "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "scoring",         "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "old",             "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "new",             "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "updated",         "type": "DATETIME", "mode": "REQUIRED"},
-    ]
 
-    write_to_bigquery(TABLES.get('changes'), schema, changes)
+def write_projections(week: int, runtime: str, rows: list, changes: list, players: dict):
 
-    return True
+    store = get_store()
 
+    store.write('projections', rows)
+    store.delete('projections', {'week': week}, before=runtime)
 
-def update_teams():
+    store.write('changes', changes)
 
-    leagues = []
+    # Only once the rows are stored, so a failed write is diffed again next time
+    projection_changes.save(week, players)
 
-    for profile in load_profiles().values():
-        for league in profile:
-            if league.get('league_id') not in [l.get('league_id') for l in leagues]:
-                leagues.append(league)
 
-    for league in leagues:
-  
-        rows = []
+def team_sources(league: dict) -> list:
+    """ The upstream reads a league's teams and roster slots come from, as [(fetch, url, kwargs)] """
 
-        if league.get('platform') == 'espn':
+    league_id = league.get('league_id')
 
-            url = f"https://lm-api-reads.fantasy.espn.com/apis/v3/games/ffl/seasons/2024/segments/0/leagues/{league.get('league_id')}?view=mTeam"
+    if league.get('platform') == 'espn':
+        url = f"{ESPN_API_URL}/seasons/2024/segments/0/leagues/{league_id}?view=mTeam&view=mSettings"
+        return [(espn_get, url, {'cookies': {'espn_s2': league.get('s2'), 'swid': league.get('swid')}})]
 
-            data = requests.get(url, cookies={'espn_s2': league.get('s2'), 'swid': league.get('swid')}).json()
+    if league.get('platform') == 'sleeper':
+        return [(sleeper_get, f"{SLEEPER_URL}/league/{league_id}{path}", {}) for path in ('', '/rosters', '/users')]
 
-            owner_map = {}
+    return []
 
-            for member in data.get('members'):
-                owner_map[member.get('id')] = f"{member.get('firstName')} {member.get('lastName')}"
 
-            for team in data.get('teams'):
-                rows.append({
-                    'league_id': league.get('league_id'),
-                    'team_id': team.get('id'),
-                    'team': cleanup(team.get('name', 'None')),
-                    'owner': cleanup(owner_map.get(team.get('owners', ['None'])[0], 'None')),
-                })
+def parse_league_teams(league: dict, payloads: list) -> tuple:
+    """ (teams rows, slots rows) for a league from the payloads of its team_sources, in the same order """
 
-        if league.get('platform') == 'sleeper':
+    rows = []
+    slots = []
 
-            rosters = {}
+    if league.get('platform') == 'espn':
 
-            for roster in requests.get(f"https://api.sleeper.app/v1/league/{league.get('league_id')}/rosters").json():
-                rosters[roster.get('owner_id')] = roster.get('roster_id')
-            
-            for user in requests.get(f"https://api.sleeper.app/v1/league/{league.get('league_id')}/users").json():
-                if not rosters.get(user.get('user_id')):
-                    continue
-                rows.append({
-                    'league_id': league.get('league_id'),
-                    'team_id': rosters.get(user.get('user_id')),
-                    'team': user.get('metadata').get('team_name') if user.get('metadata').get('team_name') else user.get('display_name'),
-                    'owner': user.get('display_name'),
-                })
+        data = payloads[0]
 
-        schema = [
-            {"name": "league_id", "type": "INTEGER", "mode": "REQUIRED"},
-            {"name": "team_id",   "type": "INTEGER", "mode": "REQUIRED"},
-            {"name": "team",      "type": "STRING",  "mode": "REQUIRED"},
-            {"name": "owner",     "type": "STRING",  "mode": "REQUIRED"},
-        ]
+        counts = data.get('settings', {}).get('rosterSettings', {}).get('lineupSlotCounts', {})
 
-        if rows:
-            run_query(f"DELETE FROM `{TABLES.get('teams')}` WHERE league_id = {league.get('league_id')}")
-            write_to_bigquery(TABLES.get('teams'), schema, rows)
+        for slot_id, count in counts.items():
+            slot = POSITION_MAP.get(int(slot_id), '').replace('/', '').replace('RBWRTE', 'FLEX')
+            if count and slot not in RESERVE_SLOTS:
+                slots.append({'league_id': league.get('league_id'), 'slot': slot, 'count': count})
 
-    return True
+        owner_map = {}
 
+        for member in data.get('members'):
+            owner_map[member.get('id')] = f"{member.get('firstName')} {member.get('lastName')}"
 
-def update_progress():
+        for team in data.get('teams'):
+            rows.append({
+                'league_id': league.get('league_id'),
+                'team_id': team.get('id'),
+                'team': cleanup(team.get('name', 'None')),
+                'owner': cleanup(owner_map.get(team.get('owners', ['None'])[0], 'None')),
+            })
 
-    rows = []
+    if league.get('platform') == 'sleeper':
+
+        settings, roster_data, users = payloads
+
+        counts = {}
+
+        for slot in settings.get('roster_positions') or []:
+            slot = slot.replace('DEF', 'DST')
+            if slot not in RESERVE_SLOTS:
+                counts[slot] = counts.get(slot, 0) + 1
+
+        for slot, count in counts.items():
+            slots.append({'league_id': league.get('league_id'), 'slot': slot, 'count': count})
+
+        rosters = {}
+
+        for roster in roster_data:
+            rosters[roster.get('owner_id')] = roster.get('roster_id')
+
+        for user in users:
+            if not rosters.get(user.get('user_id')):
+                continue
+            rows.append({
+                'league_id': league.get('league_id'),
+                'team_id': rosters.get(user.get('user_id')),
+                'team': user.get('metadata').get('team_name') if user.get('metadata').get('team_name') else user.get('display_name'),
+                'owner': user.get('display_name'),
+            })
+
+    return rows, slots
 
-    week = get_current_week()
-    year = get_current_year()
 
-    games = f"https://cdn.espn.com/core/nfl/schedule?xhr=1&year={year}&week={week}"
+def write_teams(rows: list, slots: list, league_ids: list):
 
-    for day in requests.get(games).json().get('content').get('schedule').values():
+    # One delete and one load for every league, instead of a pair per league
+    if rows:
+        get_store().delete('teams', {'league_id': league_ids})
+        get_store().write('teams', rows)
+
+    if slots:
+        get_store().delete('slots', {'league_id': sorted({slot.get('league_id') for slot in slots})})
+        get_store().write('slots', slots)
+
+
+def progress_url(year: int, week: int) -> str:
+    return f"{ESPN_CDN_URL}/core/nfl/schedule?xhr=1&year={year}&week={week}"
+
+
+def parse_progress(year: int, week: int, schedule: dict) -> list:
+
+    rows = []
+
+    for day in schedule.get('content').get('schedule').values():
         for game in day.get('games'):
             teams = [i.get('team').get('abbreviation') for i in game.get('competitions')[0].get('competitors')]
             for team in teams:
@@ -762,17 +1135,58 @@ def update_progress():
                 display = f"Q{period} {'0' if len(display) < 5 else ''}{display}"
                 rows.append({'year': year, 'week': week, 'team': team, 'progress': progress, 'display': display})
 
-    schema = [
-        {"name": "year",        "type": "INTEGER",  "mode": "REQUIRED"},
-        {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
-        {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
-        {"name": "progress",    "type": "FLOAT",    "mode": "REQUIRED"},
-        {"name": "display",     "type": "STRING",   "mode": "REQUIRED"}
-    ]
-    
+    return rows
+
+
+def write_progress(year: int, week: int, rows: list):
+
     if rows:
-        run_query(f"DELETE FROM `{TABLES.get('game_progress')}` WHERE year = {year} AND week = {week}")
-        write_to_bigquery(TABLES.get('game_progress'), schema, rows)
+        get_store().delete('game_progress', {'year': year, 'week': week})
+        get_store().write('game_progress', rows)
+
+
+def get_game_window(week: int = None) -> tuple:
+    """
+    Whether any game is live, and the seconds until the next kickoff this week (None when there isn't one), from
+    the game progress feed and the game times of the last score refresh
+    """
+
+    week = week or get_current_week()
+    now = get_current_central_datetime()
+    store = get_store()
+
+    live = any(0 < progress < 1 for progress in get_game_progress(week).values())
+    next_kickoff = None
+
+    with _scores_snapshot_lock:
+        rows = list(_scores_snapshot.get('rows').values()) if _scores_snapshot.get('week') == week else None
+
+    if rows is None:
+        rows = [dict(row) for row in store.select('scores', {'week': week})]
+
+    for row in rows:
+
+        gametime = parse_gametime(row.get('gametime'))
+
+        if row.get('play_status') in ['bye', 'played']:
+            continue
+
+        if row.get('play_status') == 'playing' or now - datetime.timedelta(hours=5) <= gametime <= now:
+            live = True
+        elif gametime > now:
+            seconds = (gametime - now).total_seconds()
+            next_kickoff = seconds if next_kickoff is None else min(next_kickoff, seconds)
+
+    return live, next_kickoff
+
+
+def remaining_fraction(player: dict, progress: float) -> float:
+    """ Share of the player's game still to be played, following the same statuses as calculate_projected """
+
+    if progress == None or player.get('play_status') in ['bye', 'played'] or player.get('status') == 'OUT':
+        return 0
+
+    return 1 if player.get('play_status') in ['future', 'today'] else max(0, 1 - progress)
 
 
 def calculate_projected(player: dict, projection: float, progress: float) -> float:
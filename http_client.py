@@ -0,0 +1,202 @@
+import email.utils
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from storage import DATA_DIR
+
+
+TIMEOUT = (float(os.environ.get('COMMANDER_HTTP_CONNECT_TIMEOUT', 5)), float(os.environ.get('COMMANDER_HTTP_READ_TIMEOUT', 30)))
+POOL_SIZE = int(os.environ.get('COMMANDER_HTTP_POOL', 16))
+RETRIES = int(os.environ.get('COMMANDER_HTTP_RETRIES', 2))
+CACHE_DIR = os.environ.get('COMMANDER_HTTP_CACHE', os.path.join(DATA_DIR, 'http'))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_retries = {}
+_stats = {}
+_stats_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+
+def configure(host: str, retries: int):
+    """ Sets the retry budget for a host before its first request, e.g. 0 where a Throttle already retries """
+    _retries[host] = retries
+
+
+def session(host: str) -> requests.Session:
+    """ One keep-alive session per host, so every fetcher reuses the same TCP/TLS connections """
+
+    with _sessions_lock:
+
+        if host not in _sessions:
+            retry = Retry(
+                total=_retries.get(host, RETRIES),
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=('GET', 'HEAD'),
+                raise_on_status=False,
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retry)
+            _sessions[host] = requests.Session()
+            _sessions[host].mount('https://', adapter)
+            _sessions[host].mount('http://', adapter)
+
+        return _sessions.get(host)
+
+
+def get(url: str, cache: bool = False, timeout=TIMEOUT, **kwargs) -> requests.Response:
+    """
+    GET through the host's pooled session. With cache=True a copy is kept under CACHE_DIR: it is served without a
+    request while Cache-Control max-age says it is fresh, and otherwise revalidated with If-None-Match /
+    If-Modified-Since, so a 304 hands back the stored body. Cached responses have from_cache set.
+    """
+
+    host = urlsplit(url).netloc
+    key = cache_key(url, kwargs.get('params')) if cache and CACHE_DIR else None
+    stored = load_cached(key) if key else None
+
+    if stored and fresh(stored):
+        count(host, 'cache_hits')
+        return cached_response(url, stored)
+
+    if stored:
+        headers = dict(kwargs.pop('headers', None) or {})
+        if stored.get('etag'):
+            headers['If-None-Match'] = stored.get('etag')
+        if stored.get('last_modified'):
+            headers['If-Modified-Since'] = stored.get('last_modified')
+        kwargs['headers'] = headers
+
+    start = time.perf_counter()
+
+    try:
+        response = session(host).get(url, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        count(host, 'requests', time.perf_counter() - start)
+        count(host, 'errors')
+        raise
+
+    count(host, 'requests', time.perf_counter() - start)
+
+    if response.status_code >= 400:
+        count(host, 'errors')
+
+    if stored and response.status_code == 304:
+        count(host, 'revalidated')
+        entry = cache_headers(response.headers) or {}
+        stored.update({field: value for field, value in entry.items() if value is not None})
+        save_cached(key, stored)
+        return cached_response(url, stored)
+
+    if key and response.status_code == 200:
+        entry = cache_headers(response.headers)
+        if entry is not None:
+            save_cached(key, entry, response.content)
+
+    response.from_cache = False
+
+    return response
+
+
+def cache_key(url: str, params=None) -> str:
+    return hashlib.sha256(json.dumps([url, sorted((params or {}).items())], default=str).encode()).hexdigest()
+
+
+def cache_headers(headers) -> dict:
+    """ Freshness and validators worth keeping from a response, or None when it must not be stored """
+
+    control = headers.get('Cache-Control', '').lower()
+
+    if 'no-store' in control:
+        return None
+
+    max_age = MAX_AGE.search(control)
+
+    return {
+        'stored': time.time(),
+        'max_age': 0 if 'no-cache' in control or not max_age else int(max_age.group(1)),
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'content_type': headers.get('Content-Type'),
+    }
+
+
+def fresh(stored: dict) -> bool:
+    return time.time() - stored.get('stored', 0) < stored.get('max_age', 0)
+
+
+def load_cached(key: str) -> dict:
+
+    path = os.path.join(CACHE_DIR, key)
+
+    try:
+        with open(f"{path}.json") as f:
+            stored = json.load(f)
+        with open(path, 'rb') as f:
+            stored['body'] = f.read()
+    except (OSError, ValueError):
+        return None
+
+    return stored
+
+
+def save_cached(key: str, entry: dict, body: bytes = None):
+    """ Writes the body (when given) and its metadata atomically, so a concurrent reader never sees half a file """
+
+    path = os.path.join(CACHE_DIR, key)
+    meta = {field: value for field, value in entry.items() if field != 'body'}
+
+    with _cache_lock:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if body is not None:
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(body)
+            os.replace(f"{path}.tmp", path)
+        with open(f"{path}.json.tmp", 'w') as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+
+def cached_response(url: str, stored: dict) -> requests.Response:
+
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = stored.get('body')
+    response.headers['Date'] = email.utils.formatdate(stored.get('stored'), usegmt=True)
+    for header, field in (('ETag', 'etag'), ('Last-Modified', 'last_modified'), ('Content-Type', 'content_type')):
+        if stored.get(field):
+            response.headers[header] = stored.get(field)
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response.from_cache = True
+
+    return response
+
+
+def count(host: str, field: str, seconds: float = None):
+
+    with _stats_lock:
+        stats = _stats.setdefault(host, {'requests': 0, 'errors': 0, 'cache_hits': 0, 'revalidated': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats[field] += 1
+        if seconds is not None:
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats.get('max_seconds'), seconds)
+
+
+def stats() -> dict:
+    """ Per-host counters: requests sent, errors, cache hits, 304 revalidations and total / slowest request seconds """
+
+    with _stats_lock:
+        return {host: dict(values) for host, values in _stats.items()}
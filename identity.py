@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import re
+import threading
+
+from espn_api.football.constant import PRO_TEAM_MAP
+
+from storage import DATA_DIR
+
+
+INDEX_PATH = os.path.join(DATA_DIR, 'player_index.json.gz')
+
+# Team codes that differ between sources; every other code is the same everywhere
+TEAM_TRANSLATIONS = [
+    {'espn': 'WSH', 'sleeper': 'WAS', 'fp': 'WAS', 'nfl': 'WSH'},
+    {'espn': 'JAX', 'sleeper': 'JAX', 'fp': 'JAC', 'nfl': 'JAX'},
+]
+
+# (from source, to source, code) -> code
+TEAM_CODES = {
+    (source, target, code): other
+    for team in TEAM_TRANSLATIONS for source, code in team.items() for target, other in team.items()
+}
+
+# Defenses have no player id anywhere, so they get the negative of ESPN's pro team id
+DST_IDS = {code: -team_id for team_id, code in PRO_TEAM_MAP.items() if team_id}
+
+SUFFIXES = re.compile(r'\b(jr|sr|ii|iii|iv|v)\b')
+PUNCTUATION = re.compile(r"[^a-z ]")
+
+_index = {'loaded': None, 'espn': {}, 'yahoo': {}, 'fantasy_data': {}, 'names': {}}
+_index_lock = threading.Lock()
+
+
+def translate_team(input: str, output: str, team_name: str) -> str:
+
+    if not team_name:
+        return ''
+
+    return TEAM_CODES.get((input, output, team_name), team_name)
+
+
+def dst_id(team: str, source: str = 'espn') -> int:
+    return DST_IDS.get(translate_team(source, 'espn', team))
+
+
+def name_key(name: str, team: str) -> str:
+    """ Lower-case name without punctuation or suffixes, plus the ESPN team code, for matching when no id links up """
+
+    name = SUFFIXES.sub('', PUNCTUATION.sub('', (name or '').lower().replace('-', ' ')))
+    return f"{' '.join(name.split())}|{team or ''}"
+
+
+def build_index(players: dict) -> dict:
+    """ Maps ESPN, Yahoo and FantasyData ids, and name keys, from Sleeper's player catalog to canonical player ids """
+
+    index = {'espn': {}, 'yahoo': {}, 'fantasy_data': {}, 'names': {}}
+
+    for sleeper_id, player in players.items():
+
+        if player.get('position') == 'DEF':
+            continue
+
+        try:
+            canonical = int(sleeper_id)
+        except ValueError:
+            continue
+
+        for source in ('espn', 'yahoo', 'fantasy_data'):
+            if player.get(f"{source}_id"):
+                index[source][str(player.get(f"{source}_id"))] = canonical
+
+        if player.get('full_name') and player.get('team'):
+            index['names'][name_key(player.get('full_name'), translate_team('sleeper', 'espn', player.get('team')))] = canonical
+
+    return index
+
+
+def save_index(index: dict):
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    with gzip.open(f"{INDEX_PATH}.tmp", 'wt') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+    os.replace(f"{INDEX_PATH}.tmp", INDEX_PATH)
+
+
+def load_index() -> dict:
+    """ The persisted index, re-read whenever the file has been rebuilt since it was last loaded """
+
+    with _index_lock:
+
+        try:
+            modified = os.path.getmtime(INDEX_PATH)
+        except OSError:
+            return _index
+
+        if _index.get('loaded') != modified:
+            with gzip.open(INDEX_PATH, 'rt') as f:
+                _index.update(json.load(f), loaded=modified)
+
+        return _index
+
+
+def sleeper_player_id(sleeper_id: str, team: str) -> int:
+    return int(sleeper_id) if sleeper_id.isdigit() else dst_id(team, 'sleeper')
+
+
+def espn_player_id(index: dict, espn_id: int, name: str, team: str, position: str) -> int:
+
+    if position == 'DST':
+        return dst_id(team)
+
+    return index.get('espn').get(str(espn_id)) or index.get('names').get(name_key(name, team))
+
+
+def fantasypros_player_id(index: dict, player: dict) -> int:
+
+    team = translate_team('fp', 'espn', player.get('player_team_id'))
+
+    if player.get('player_position_id') == 'DST':
+        return dst_id(team)
+
+    return (
+        index.get('yahoo').get(str(player.get('player_yahoo_id')))
+        or index.get('fantasy_data').get(str(player.get('sportsdata_id')))
+        or index.get('names').get(name_key(player.get('player_name'), team))
+    )
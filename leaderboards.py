@@ -0,0 +1,122 @@
+import heapq
+import itertools
+import threading
+
+
+# Category name -> (index of the value in a result tuple, whether higher is better)
+WEEKLY_RECORDS = {
+    'Highest Points (Week)': (4, True),
+    'Lowest Points (Week)': (4, False),
+    'Highest Projected (Week)': (5, True),
+    'Lowest Projected (Week)': (5, False),
+    'Best Outcome (Week)': (6, True),
+    'Worst Outcome (Week)': (6, False),
+}
+
+
+class Leaderboard:
+    """
+    Records for one league, updated as weekly results are added. Each weekly category is a bounded heap of its k
+    best entries, so adding a result costs O(log k) and reading one costs O(k). Season totals and win streaks are
+    kept as running per-owner state and only re-ranked after new results arrive.
+
+    Results are (year, week, matchup_id, owner, score, projected, diff) tuples, as stored in the history table.
+    """
+
+    def __init__(self, k: int = 3):
+        self.k = k
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+        self.weeks = set()
+        self.seen = set()
+        self.heaps = {name: [] for name in WEEKLY_RECORDS.keys()}
+        self.seasons = {}
+        self.matchups = {}
+        self.outcomes = {}
+        self.ranked = None
+
+    def add_rows(self, rows: list):
+        """ Adds history rows; rows with matchup_id 0 only mark a week as known """
+
+        with self.lock:
+
+            for row in rows:
+
+                self.weeks.add((row.get('year'), row.get('week')))
+
+                key = (row.get('year'), row.get('week'), row.get('team_id'))
+
+                if not row.get('matchup_id') or key in self.seen:
+                    continue
+
+                self.seen.add(key)
+                self.add((row.get('year'), row.get('week'), row.get('matchup_id'), row.get('owner'), row.get('score'), row.get('projected'), row.get('diff')))
+
+            self.ranked = None
+
+    def add(self, result: tuple):
+
+        order = next(self.counter)
+
+        for name, (index, highest) in WEEKLY_RECORDS.items():
+            heap = self.heaps.get(name)
+            item = (result[index] if highest else -result[index], -order, result)
+            if len(heap) < self.k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+        year, week, matchup_id, owner = result[0:4]
+
+        season = self.seasons.setdefault((year, owner), [0, 0])
+        season[0] += result[4]
+        season[1] += result[5]
+
+        opponents = self.matchups.setdefault((year, week, matchup_id), [])
+
+        for other in opponents:
+            self.outcomes.setdefault(owner, {})[(year, week)] = result[4] > other[4]
+            self.outcomes.setdefault(other[3], {})[(year, week)] = other[4] > result[4]
+
+        opponents.append(result)
+
+    def records(self) -> dict:
+
+        with self.lock:
+
+            if not self.seen:
+                return {}
+
+            if self.ranked is None:
+                self.ranked = self.rank_seasons()
+
+            records = {name: [item[2] for item in sorted(heap, reverse=True)] for name, heap in self.heaps.items()}
+            records.update(self.ranked)
+
+            return records
+
+    def rank_seasons(self) -> dict:
+
+        totals = [
+            (year, '', 0, owner, round(points, 2), round(projected, 2), round(points - projected, 2))
+            for (year, owner), (points, projected) in self.seasons.items()
+        ]
+
+        streaks = []
+
+        for owner, outcomes in self.outcomes.items():
+
+            best = current = (0, None)
+
+            for year_week in sorted(outcomes.keys()):
+                current = (current[0] + 1, year_week) if outcomes.get(year_week) else (0, None)
+                best = max(best, current, key=lambda x: x[0])
+
+            if best[0]:
+                streaks.append((best[1][0], best[1][1], 0, owner, best[0], None, None))
+
+        return {
+            'Highest Points (Season)': heapq.nlargest(self.k, totals, key=lambda x: x[4]),
+            'Longest Win Streak': heapq.nlargest(self.k, streaks, key=lambda x: x[4]),
+        }
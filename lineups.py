@@ -0,0 +1,124 @@
+import math
+
+
+# Slot -> positions that may fill it. ESPN slot names are espn_api's POSITION_MAP names without the '/', Sleeper's
+# are its roster_positions; any other slot only takes its own position.
+SLOT_ELIGIBILITY = {
+    'TQB': {'QB'},
+    'RBWR': {'RB', 'WR'},
+    'WRRB_FLEX': {'RB', 'WR'},
+    'WRTE': {'WR', 'TE'},
+    'REC_FLEX': {'WR', 'TE'},
+    'FLEX': {'RB', 'WR', 'TE'},
+    'OP': {'QB', 'RB', 'WR', 'TE'},
+    'SUPER_FLEX': {'QB', 'RB', 'WR', 'TE'},
+    'DL': {'DL', 'DT', 'DE'},
+    'DB': {'DB', 'CB', 'S'},
+    'DP': {'DL', 'DT', 'DE', 'LB', 'DB', 'CB', 'S'},
+    'IDP_FLEX': {'DL', 'DT', 'DE', 'LB', 'DB', 'CB', 'S'},
+}
+
+SLOT_ORDER = [
+    'QB', 'TQB', 'RB', 'RBWR', 'WRRB_FLEX', 'WR', 'WRTE', 'REC_FLEX', 'TE', 'FLEX', 'OP', 'SUPER_FLEX',
+    'DT', 'DE', 'DL', 'LB', 'CB', 'S', 'DB', 'DP', 'IDP_FLEX', 'DST', 'K', 'P', 'HC',
+]
+
+RESERVE_SLOTS = ('BE', 'BN', 'IR', 'TAXI', '')
+
+# The lineup max mode assumed before league settings were stored
+DEFAULT_SLOTS = {'QB': 1, 'RB': 2, 'WR': 2, 'TE': 1, 'FLEX': 1, 'DST': 1, 'K': 1}
+
+
+def eligible(slot: str, position: str) -> bool:
+    return position in SLOT_ELIGIBILITY.get(slot, {slot})
+
+
+def optimal_lineup(players: list, slots: dict) -> list:
+    """
+    Fills a league's starting slots ({slot: count}) with the players maximizing the total projection, as an
+    assignment problem, so flex and superflex slots are only given the players the fixed slots can spare. Slots no
+    rostered player can fill are left empty. Returns the chosen players in slot order.
+    """
+
+    rows = [slot for slot in sorted(slots.keys(), key=slot_rank) for _ in range(slots.get(slot))]
+
+    if not rows or not players:
+        return []
+
+    # One "empty" column per row lets a slot go unfilled instead of taking an ineligible player
+    blocked = 1 + sum(abs(p.get('projected') or 0) for p in players) * 2
+    cost = [
+        [-(p.get('projected') or 0) if eligible(slot, p.get('position')) else blocked for p in players] + [0] * len(rows)
+        for slot in rows
+    ]
+
+    lineup = []
+
+    for row, column in enumerate(assign(cost)):
+        if column < len(players) and cost[row][column] != blocked:
+            lineup.append(players[column])
+
+    return lineup
+
+
+def slot_rank(slot: str) -> tuple:
+    return (SLOT_ORDER.index(slot), slot) if slot in SLOT_ORDER else (len(SLOT_ORDER), slot)
+
+
+def assign(cost: list) -> list:
+    """
+    Minimum-cost assignment of every row to a distinct column (rows <= columns), by the Hungarian algorithm in
+    O(rows^2 * columns). Returns the column chosen for each row.
+    """
+
+    n, m = len(cost), len(cost[0])
+    u = [0] * (n + 1)
+    v = [0] * (m + 1)
+    match = [0] * (m + 1)
+    way = [0] * (m + 1)
+
+    for i in range(1, n + 1):
+
+        match[0] = i
+        j0 = 0
+        minv = [math.inf] * (m + 1)
+        used = [False] * (m + 1)
+
+        while match[j0]:
+
+            used[j0] = True
+            i0 = match[j0]
+            delta = math.inf
+            j1 = 0
+
+            for j in range(1, m + 1):
+                if not used[j]:
+                    current = cost[i0 - 1][j - 1] - u[i0] - v[j]
+                    if current < minv[j]:
+                        minv[j] = current
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+
+            for j in range(m + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+
+            j0 = j1
+
+        while j0:
+            j1 = way[j0]
+            match[j0] = match[j1]
+            j0 = j1
+
+    columns = [0] * n
+
+    for j in range(1, m + 1):
+        if match[j]:
+            columns[match[j] - 1] = j - 1
+
+    return columns
@@ -0,0 +1,86 @@
+import json
+import queue
+import threading
+
+
+class Broadcaster:
+    """
+    Fan-out of scoreboard changes to open streams. Each key (profile, week, mode) remembers the fragments it last
+    published and the version of the scoreboard they came from. Subscribers only receive the fragments that changed
+    since then, or a reload when the set of elements itself changed or they are showing an older version than the
+    one being published from. Every event carries the version, so a reconnecting browser says what it is showing.
+    """
+
+    def __init__(self, backlog: int = 16, limit: int = None):
+        self.backlog = backlog
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.published = {}
+
+    def subscribe(self, key: tuple, version: str = None, baseline=None) -> queue.Queue:
+        """
+        version is the scoreboard version the client is showing; baseline is called for the key's current
+        (version, fragments) when nothing has been published for it yet. Returns None when limit streams are open.
+        """
+
+        subscriber = queue.Queue(maxsize=self.backlog)
+
+        with self.lock:
+            if self.limit is not None and sum(map(len, self.subscribers.values())) >= self.limit:
+                return None
+            self.subscribers.setdefault(key, set()).add(subscriber)
+            missing = key not in self.published
+
+        if missing and baseline:
+            current = baseline()
+            with self.lock:
+                self.published.setdefault(key, current)
+
+        with self.lock:
+            current_version = self.published.get(key, (None, {}))[0]
+
+        # Anything published between the page being served and this stream opening would otherwise never arrive
+        if version != current_version:
+            subscriber.put_nowait(('reload', '{}', current_version))
+
+        return subscriber
+
+    def unsubscribe(self, key: tuple, subscriber: queue.Queue):
+        with self.lock:
+            self.subscribers.get(key, set()).discard(subscriber)
+            if not self.subscribers.get(key):
+                self.subscribers.pop(key, None)
+                self.published.pop(key, None)
+
+    def keys(self) -> list:
+        with self.lock:
+            return list(self.subscribers.keys())
+
+    def publish(self, key: tuple, version: str, fragments: dict):
+
+        with self.lock:
+            last_version, last = self.published.get(key, (None, {}))
+            self.published[key] = (version, fragments)
+            subscribers = list(self.subscribers.get(key, set()))
+
+        if fragments.keys() != last.keys():
+            event = ('reload', '{}', version)
+        else:
+            changed = {element: html for element, html in fragments.items() if last.get(element) != html}
+            if changed:
+                event = ('update', json.dumps(changed), version)
+            elif version != last_version:
+                # Nothing on screen moved, but the browser should still reconnect as being on the new version
+                event = ('version', '{}', version)
+            else:
+                return
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # A client this far behind is better off reloading the page
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(('reload', '{}', version))
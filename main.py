@@ -1,5 +1,11 @@
 import datetime
+import hashlib
+import json
+import os
+import queue
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
 import requests
@@ -7,45 +13,193 @@ from flask import Flask, render_template, request, Response
 from google.cloud import bigquery
 
 import helpers
+import live
+import metrics
+import pipeline
+import scheduler
+from storage import Batch, get_store
 
-TABLE_NAMES = {
-    'teams': 'commander.teams',
-    'projections': 'commander.projections',
-    'scores': 'commander.scores',
-    'changes': 'commander.changes',
-}
+STREAM_SECONDS = 600
+# Each open stream holds one of the worker's threads (32 in the Dockerfile), so leave the rest for pages and updates
+MAX_STREAMS = int(os.environ.get('COMMANDER_MAX_STREAMS', 16))
+SNAPSHOT_MODES = ('default', 'max', 'all')
 
 app = Flask(__name__)
+scoreboards = live.Broadcaster(limit=MAX_STREAMS)
+snapshots = {}
+snapshots_lock = threading.Lock()
+ingest_lock = threading.Lock()
 
 
 @app.route("/update/all", methods=['GET'])
 def update_all():
     """ Update all but live scores """
 
-    responses = []
+    if not ingest_lock.acquire(blocking=False):
+        return Response('Update already running', 409)
 
-    responses.append(('projections', helpers.update_projections()))
-    responses.append(('teams', helpers.update_teams()))
-    update_scores()
+    try:
+        helpers.invalidate_profiles()
+        responses = {'players': refresh_players(), **refresh(pipeline.SOURCES)}
+    finally:
+        ingest_lock.release()
 
-    response = ', '.join(f"{key}: {value}" for key, value in responses)
+    response = ', '.join(f"{key}: {value}" for key, value in responses.items())
 
-    return Response(response, status=200 if False not in [r[1] for r in responses] else 500)
+    return Response(response, status=200 if all(responses.values()) else 500)
 
 
 @app.route("/update/scores", methods=['GET'])
 def update_scores():
-    helpers.update_progress()
-    helpers.update_all_scores()
+
+    if not ingest_lock.acquire(blocking=False):
+        return Response('Update already running', 409)
+
+    try:
+        responses = refresh_scores(differential=request.args.get('differential') == '1')
+    finally:
+        ingest_lock.release()
+
+    if not all(responses.values()):
+        return Response(', '.join(f"{key}: {value}" for key, value in responses.items()), 500)
+
     return Response('Success', 200)
 
 
+def refresh(sources: tuple, differential: bool = False) -> dict:
+    """
+    One pipeline cycle over the given sources. Every source feeds the scoreboards (projections, rosters, scores and
+    game progress), so the snapshots and open streams are rebuilt after any of them
+    """
+
+    responses = pipeline.run(helpers.get_current_week(), sources, differential)
+
+    build_snapshots()
+
+    return responses
+
+
+def refresh_players() -> bool:
+    """ The Sleeper catalog and the player identity index built from it, which scoreboard reads only load from disk """
+
+    try:
+        helpers.load_sleeper_players()
+        return True
+    except (requests.RequestException, ValueError) as e:
+        print(f"player index unavailable: {e!r}")
+        return False
+
+
+def refresh_projections() -> bool:
+    return refresh(('projections',)).get('projections')
+
+
+def refresh_teams() -> bool:
+    helpers.invalidate_profiles()
+    return refresh(('teams',)).get('teams')
+
+
+def refresh_scores(differential: bool = False) -> dict:
+    return refresh(('progress', 'scores'), differential)
+
+
+@metrics.timed('build_snapshots')
+def build_snapshots():
+    """
+    Materializes every profile's current week scoreboard in each mode right after an ingest, then pushes the changes
+    to any open streams, so page views between updates don't touch the database
+    """
+
+    week = helpers.get_current_week()
+    profiles = helpers.load_profiles().keys()
+    streams = scoreboards.keys()
+
+    keys = {(profile, week, mode) for profile in profiles for mode in SNAPSHOT_MODES}
+    keys.update(streams)
+
+    built = {}
+    fragments = {}
+
+    for key in keys:
+
+        matchups = helpers.get_all_matchups(*key)
+        version = scoreboard_version(matchups)
+
+        if key[0] in profiles and key[2] in SNAPSHOT_MODES:
+            built[key] = render_snapshot(key, matchups, version)
+        if key in streams:
+            fragments[key] = (version, render_fragments(matchups))
+
+    with snapshots_lock:
+        snapshots.clear()
+        snapshots.update(built)
+
+    for key, (version, key_fragments) in fragments.items():
+        scoreboards.publish(key, version, key_fragments)
+
+
+def scoreboard_version(matchups: list) -> str:
+    """ Digest of the data behind a scoreboard, shared by its page and its stream so each can tell what the other shows """
+    return hashlib.sha256(json.dumps(matchups, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def render_snapshot(key: tuple, matchups: list, version: str = None) -> tuple:
+
+    profile, week, mode = key
+    version = version or scoreboard_version(matchups)
+
+    with app.test_request_context(f"/{profile}/"), metrics.timer('render', template='leagues'):
+        html = render_template('leagues.html', matchups=matchups, week=week, profile=profile, mode=mode, version=version)
+
+    return hashlib.sha256(html.encode()).hexdigest()[:32], html
+
+
+def render_fragments(matchups: list) -> dict:
+    """ Renders each team header and player row of a scoreboard on its own, keyed by element id """
+
+    start = time.perf_counter()
+    macros = app.jinja_env.get_template('scoreboard.html').module
+    fragments = {}
+
+    for matchup in matchups:
+        for index, team in enumerate(matchup.values()):
+            class_ = "odd" if index % 2 == 1 else "even"
+            fragments[f"t-{team.get('league_id')}-{team.get('id')}"] = str(macros.team_header(team, class_)).strip()
+            for player_index, player in enumerate(team.get('players').get('show')):
+                fragments[f"p-{team.get('league_id')}-{team.get('id')}-{player_index}"] = str(macros.player_row(team, player, player_index, class_)).strip()
+
+    metrics.observe('render', time.perf_counter() - start, template='fragments')
+
+    return fragments
+
+
+@app.before_request
+def start_timing():
+    metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response: Response) -> Response:
+
+    timing = metrics.server_timing()
+
+    if timing:
+        response.headers['Server-Timing'] = timing
+
+    return response
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route("/changes", methods=['GET'])
 def list_changes():
 
     changes = []
 
-    for change in helpers.run_query(f"SELECT * FROM `{TABLE_NAMES.get('changes')}` ORDER BY updated DESC LIMIT 20", as_list=True):
+    for change in get_store().select('changes', order_by=['updated DESC'], limit=20):
         change = dict(change)
         change['diff'] = f"<span class='change-{'negative' if change.get('old') > change.get('new') else 'positive'}'>" \
                          f"{'-' if change.get('old') > change.get('new') else '+'}{abs(change.get('old') - change.get('new'))}</span>"
@@ -59,7 +213,6 @@ def records():
 
     leagues = []
     records = {}
-    data = {}
 
     profiles = helpers.load_profiles()
 
@@ -77,30 +230,14 @@ def records():
             if league_data not in leagues:
                 leagues.append(league_data)
 
-    threads = []
-
-    for league in leagues:
+    batch = Batch(get_store())
 
-        thread = threading.Thread(target=helpers.get_league_data, args=(data, league))
-        thread.start()
-        threads.append(thread)
-    
-    for thread in threads:
-        thread.join()
+    with ThreadPoolExecutor(max_workers=helpers.ESPN.concurrency) as pool:
+        for league, league_records in zip(leagues, pool.map(lambda league: helpers.get_league_records(league, batch), leagues)):
+            if league_records:
+                records[league.get('name')] = league_records
 
-    for league_name, league_data in data.items():
-
-        if not league_data:
-            continue
-
-        records[league_name] = {
-            'Highest Points (Week)': sorted(league_data, key=lambda x: x[4], reverse=True)[0:3],
-            'Lowest Points (Week)': sorted(league_data, key=lambda x: x[4])[0:3],
-            'Highest Projected (Week)': sorted(league_data, key=lambda x: x[5], reverse=True)[0:3],
-            'Lowest Projected (Week)': sorted(league_data, key=lambda x: x[5])[0:3],
-            'Best Outcome (Week)': sorted(league_data, key=lambda x: x[6], reverse=True)[0:3],
-            'Worst Outcome (Week)': sorted(league_data, key=lambda x: x[6])[0:3],
-        }
+    batch.commit()
 
     return render_template('records.html', records=records)
 
@@ -119,9 +256,81 @@ def index_mode(profile: str, mode: str):
 def index_profile(profile: str, mode: str = 'default'):
 
     week = int(request.args.get('week')) if 'week' in request.args.keys() else helpers.get_current_week()
-    matchups = helpers.get_all_matchups(profile, week, mode)
+    key = (profile, week, mode)
+
+    with snapshots_lock:
+        snapshot = snapshots.get(key)
+
+    if snapshot is None:
+        snapshot = render_snapshot(key, helpers.get_all_matchups(profile, week, mode))
+        # Unknown profiles and modes aren't kept, so arbitrary URLs can't grow the cache
+        if profile in helpers.load_profiles().keys() and mode in SNAPSHOT_MODES:
+            with snapshots_lock:
+                snapshots[key] = snapshot
+
+    response = Response(snapshot[1], mimetype='text/html')
+    response.set_etag(snapshot[0])
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response.make_conditional(request)
+
+
+@app.route("/<string:profile>/stream", methods=['GET'])
+def stream(profile: str):
+    """
+    Server-sent events with the scoreboard fragments that change after each score update. The browser says which
+    version it is showing, from the page on the first connect and from the last event id on reconnects, and is told
+    to reload if that is no longer current
+    """
+
+    week = int(request.args.get('week')) if 'week' in request.args.keys() else helpers.get_current_week()
+    key = (profile, week, request.args.get('mode', 'default'))
+    version = request.headers.get('Last-Event-ID') or request.args.get('version')
+
+    def baseline() -> tuple:
+        matchups = helpers.get_all_matchups(*key)
+        return scoreboard_version(matchups), render_fragments(matchups)
+
+    subscriber = scoreboards.subscribe(key, version, baseline)
+
+    # The page falls back to reloading itself every minute
+    if subscriber is None:
+        return Response('Too many open streams', 503)
+
+    def events():
+
+        deadline = time.monotonic() + STREAM_SECONDS
+
+        yield "retry: 5000\n\n"
+        # Closed after a while so the worker thread is freed; the browser reconnects on its own
+        while time.monotonic() < deadline:
+            try:
+                event, data, event_version = subscriber.get(timeout=15)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {event_version}\nevent: {event}\ndata: {data}\n\n"
+
+    response = Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: scoreboards.unsubscribe(key, subscriber))
+
+    return response
+
+
+def start_scheduler():
+    """ Polls scores quickly only while games are live, with projections and teams on their own slower schedules """
+
+    ingest = scheduler.Scheduler(ingest_lock)
+    # First, so the player index is on disk before the first projections and scores are matched against it
+    ingest.add('players', refresh_players, lambda: helpers.SLEEPER_PLAYERS_TTL)
+    ingest.add('scores', lambda: refresh_scores(differential=True), lambda: scheduler.score_interval(*helpers.get_game_window()))
+    ingest.add('projections', refresh_projections, lambda: scheduler.PROJECTIONS_INTERVAL)
+    ingest.add('teams', refresh_teams, lambda: scheduler.TEAMS_INTERVAL)
+    ingest.start()
+
 
-    return render_template('leagues.html', matchups=matchups, week=week)
+if os.environ.get('COMMANDER_SCHEDULER'):
+    start_scheduler()
 
 
 if __name__ == '__main__':
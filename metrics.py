@@ -0,0 +1,127 @@
+import contextlib
+import contextvars
+import functools
+import os
+import re
+import threading
+import time
+
+import http_client
+
+
+SERVER_TIMING = bool(os.environ.get('COMMANDER_SERVER_TIMING'))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NOT_TOKEN = re.compile(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]")
+HTTP_COUNTERS = {
+    'requests': ('commander_http_requests_total', 'counter', 'Requests sent to each upstream host'),
+    'errors': ('commander_http_errors_total', 'counter', 'Failed requests and error responses per host'),
+    'cache_hits': ('commander_http_cache_hits_total', 'counter', 'Responses served fresh from the HTTP cache'),
+    'revalidated': ('commander_http_revalidated_total', 'counter', 'Cached responses revalidated with a 304'),
+    'seconds': ('commander_http_request_seconds_total', 'counter', 'Total time spent waiting on each host'),
+    'max_seconds': ('commander_http_request_seconds_max', 'gauge', 'Slowest single request to each host'),
+}
+
+# (stage, labels) -> [bucket counts, sum, count]
+_stages = {}
+_stages_lock = threading.Lock()
+_request = contextvars.ContextVar('metrics_request', default=None)
+
+
+def observe(stage: str, seconds: float, **labels):
+    """ Records one timing for a stage, and adds it to the current request's Server-Timing when one is collected """
+
+    key = (stage, tuple(sorted((name, str(value)) for name, value in labels.items())))
+
+    with _stages_lock:
+        histogram = _stages.setdefault(key, [[0] * len(BUCKETS), 0.0, 0])
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    timings = _request.get()
+
+    if timings is not None:
+        name = NOT_TOKEN.sub('_', '.'.join([stage] + [str(value) for value in labels.values()]))
+        timings[name] = timings.get(name, 0) + seconds
+
+
+@contextlib.contextmanager
+def timer(stage: str, **labels):
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def timed(stage: str):
+    """ Decorator timing every call of a function as one stage """
+
+    def decorator(fn):
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_request():
+    """ Starts collecting Server-Timing entries for the current request, if enabled """
+    if SERVER_TIMING:
+        _request.set({})
+
+
+def server_timing() -> str:
+
+    timings = _request.get()
+
+    if not timings:
+        return None
+
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def submit(pool, fn, *args):
+    """ pool.submit that keeps the caller's request context, so work done on the pool still shows in Server-Timing """
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def render() -> str:
+    """ Stage histograms and per-host HTTP counters in the Prometheus text format """
+
+    lines = [
+        '# HELP commander_stage_seconds Time spent in each ingest and page stage',
+        '# TYPE commander_stage_seconds histogram',
+    ]
+
+    with _stages_lock:
+        stages = {key: (list(buckets), total, count) for key, (buckets, total, count) in _stages.items()}
+
+    for (stage, labels), (buckets, total, count) in sorted(stages.items()):
+
+        label = ','.join([f'stage="{stage}"'] + [f'{name}="{value}"' for name, value in labels])
+
+        for bound, observed in zip(BUCKETS, buckets):
+            lines.append(f'commander_stage_seconds_bucket{{{label},le="{bound}"}} {observed}')
+
+        lines.append(f'commander_stage_seconds_bucket{{{label},le="+Inf"}} {count}')
+        lines.append(f'commander_stage_seconds_sum{{{label}}} {total}')
+        lines.append(f'commander_stage_seconds_count{{{label}}} {count}')
+
+    hosts = http_client.stats()
+
+    for field, (name, kind, description) in HTTP_COUNTERS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for host, values in sorted(hosts.items()):
+            lines.append(f'{name}{{host="{host}"}} {values.get(field)}')
+
+    return '\n'.join(lines) + '\n'
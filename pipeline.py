@@ -0,0 +1,203 @@
+import asyncio
+import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import helpers
+import metrics
+from identity import translate_team
+from throttle import CircuitOpen
+
+
+SOURCES = ('progress', 'teams', 'projections', 'scores')
+HOST_CONCURRENCY = helpers.INGEST_WORKERS
+THREADS = int(os.environ.get('COMMANDER_PIPELINE_THREADS', 32))
+# The stage each source is timed as in /metrics
+STAGES = {'progress': 'update_progress', 'teams': 'update_teams', 'projections': 'update_projections', 'scores': 'update_all_scores'}
+
+
+def run(week: int, sources: tuple = SOURCES, differential: bool = False) -> dict:
+    """ Runs one ingest cycle for the given sources and returns {source: whether it was fetched and written} """
+    return asyncio.run(Cycle(week, differential).run(sources))
+
+
+class Cycle:
+    """
+    One ingest cycle. Every upstream read runs on a worker thread under its host's concurrency limit, so the schedule,
+    league views, Sleeper matchups, rosters and users, and the FantasyPros pages are all in flight together. Each
+    source parses what it fetched into rows, and one writer sends them all to the store once everything is in.
+    """
+
+    def __init__(self, week: int, differential: bool = False):
+        self.week = week
+        self.year = helpers.get_current_year()
+        self.differential = differential
+        self.limits = {}
+        self.writes = []
+        self.progress_rows = None
+        self.game_progress = None
+
+    async def run(self, sources: tuple) -> dict:
+
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREADS, thread_name_prefix='pipeline'))
+
+        tasks = {}
+
+        for name in SOURCES:
+            if name == 'scores' and 'scores' in sources:
+                tasks[name] = asyncio.create_task(self.source(name, self.scores(tasks.get('progress'))))
+            elif name in sources:
+                tasks[name] = asyncio.create_task(self.source(name, getattr(self, name)()))
+
+        results = {name: await task for name, task in tasks.items()}
+
+        with metrics.timer('ingest_write'):
+            for name in await asyncio.to_thread(self.write):
+                results[name] = False
+
+        return results
+
+    async def source(self, name: str, coroutine) -> bool:
+        """ A failed source is logged and left out of the write; the others still go through """
+
+        try:
+            with metrics.timer(STAGES.get(name)):
+                await coroutine
+            return True
+        except Exception as e:
+            print(f"pipeline: {name} failed: {e!r}")
+            return False
+
+    async def fetch(self, url: str, fn, *args, **kwargs):
+        """ Runs fn on a worker thread, holding one of the concurrency slots for url's host """
+
+        limit = self.limits.setdefault(urlsplit(url).netloc, asyncio.Semaphore(HOST_CONCURRENCY))
+
+        async with limit:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    def write(self) -> list:
+        """ Sends every source's rows to the store from one thread, in SOURCES order, and returns the sources that failed """
+
+        failed = []
+
+        for name, fn, args in sorted(self.writes, key=lambda write: SOURCES.index(write[0])):
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"pipeline: writing {name} failed: {e!r}")
+                failed.append(name)
+
+        return failed
+
+    async def progress(self):
+
+        url = helpers.progress_url(self.year, self.week)
+        self.progress_rows = helpers.parse_progress(self.year, self.week, await self.fetch(url, helpers.espn_get, url))
+
+        self.writes.append(('progress', helpers.write_progress, (self.year, self.week, self.progress_rows)))
+
+    async def teams(self):
+
+        rows = []
+        slots = []
+        fetched = []
+
+        leagues = await asyncio.to_thread(helpers.unique_leagues)
+
+        for league, (league_rows, league_slots) in zip(leagues, await asyncio.gather(*map(self.league_teams, leagues))):
+            if league_rows:
+                rows.extend(league_rows)
+                slots.extend(league_slots)
+                fetched.append(league.get('league_id'))
+
+        self.writes.append(('teams', helpers.write_teams, (rows, slots, fetched)))
+
+    async def league_teams(self, league: dict) -> tuple:
+        """ A league that can't be fetched keeps its stored teams and slots """
+
+        try:
+            payloads = await asyncio.gather(*(self.fetch(url, fetch, url, **kwargs) for fetch, url, kwargs in helpers.team_sources(league)))
+        except helpers.ESPN_ERRORS + (CircuitOpen,) as e:
+            print(f"teams: league {league.get('league_id')} unavailable: {e!r}")
+            return [], []
+
+        return helpers.parse_league_teams(league, payloads)
+
+    async def projections(self):
+
+        runtime = helpers.get_current_central_datetime().strftime('%Y-%m-%d %H:%M:%S')
+        pages = helpers.projection_pages(self.week)
+
+        empty = set()
+
+        with metrics.timer('get_all_projections'):
+            payloads = await asyncio.gather(*(self.fetch(url, helpers.get_projection_page, url) for url in pages.keys()))
+            projections = await asyncio.to_thread(helpers.parse_projections, pages, dict(zip(pages.keys(), payloads)), empty)
+
+        rows, changes, players = await asyncio.to_thread(helpers.build_projections, self.week, projections, runtime, empty)
+
+        self.writes.append(('projections', helpers.write_projections, (self.week, runtime, rows, changes, players)))
+
+    async def progress_by_team(self, progress: asyncio.Task) -> dict:
+        """ {ESPN team code: progress} from this cycle's schedule when it was fetched, else from the last one stored """
+
+        if self.game_progress is None:
+
+            if progress:
+                await asyncio.wait([progress])
+
+            if progress and progress.result():
+                self.game_progress = {translate_team('nfl', 'espn', row.get('team')): row.get('progress') for row in self.progress_rows}
+            else:
+                self.game_progress = await asyncio.to_thread(helpers.get_game_progress, self.week)
+
+        return self.game_progress
+
+    async def scores(self, progress: asyncio.Task = None):
+
+        runtime = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        players = []
+        matchups = []
+        fetched = []
+
+        # Only a differential cycle needs game progress before it knows which leagues to fetch
+        selected_progress = await self.progress_by_team(progress) if self.differential else {}
+        espn_leagues, sleeper_leagues = await asyncio.to_thread(helpers.select_score_leagues, self.week, selected_progress, self.differential)
+        gametimes = helpers.week_gametimes(self.week)
+
+        # Sleeper matchups download alongside ESPN's box scores, but need ESPN's game times before they become rows
+        sleeper_teams = [
+            asyncio.create_task(self.fetch(helpers.SLEEPER_URL, helpers.fetch_league_scores, helpers.fetch_sleeper_matchups, league_id, self.week))
+            for league_id in sleeper_leagues
+        ]
+
+        results = await asyncio.gather(*(
+            self.fetch(helpers.ESPN_API_URL, helpers.fetch_league_scores, helpers.get_espn_scores, league_id, self.week, runtime)
+            for league_id in espn_leagues
+        ))
+
+        helpers.collect_scores(espn_leagues, results, players, matchups, fetched, gametimes)
+        helpers.settle_gametimes(gametimes, await self.progress_by_team(progress))
+
+        results = []
+
+        for league_id, teams in zip(sleeper_leagues, await asyncio.gather(*sleeper_teams)):
+            if teams is None:
+                results.append(None)
+            else:
+                results.append(await asyncio.to_thread(self.sleeper_scores, league_id, runtime, gametimes, teams))
+
+        helpers.collect_scores(sleeper_leagues, results, players, matchups, fetched)
+
+        self.writes.append(('scores', helpers.commit_scores, (self.week, players, matchups, fetched)))
+
+    def sleeper_scores(self, league_id: int, runtime: str, gametimes: dict, teams: list) -> tuple:
+        """ Like a league that can't be fetched, one whose players can't be loaded keeps its last written scores """
+
+        try:
+            return helpers.build_sleeper_scores(league_id, self.week, runtime, gametimes, teams)
+        except helpers.ESPN_ERRORS + (CircuitOpen, ValueError) as e:
+            print(f"scores: league {league_id} unavailable: {e!r}")
+            return None
@@ -0,0 +1,169 @@
+import gzip
+import json
+import os
+import threading
+
+from storage import DATA_DIR, get_store
+
+
+FORMATS = ('standard', 'half-point-ppr', 'ppr')
+SNAPSHOT_PATH = os.path.join(DATA_DIR, 'projections_snapshot.json.gz')
+
+# position -> {'absolute': points, 'relative': fraction of the old projection}; a change has to pass both to be
+# recorded, and a position without its own entry uses the default
+THRESHOLDS = {'default': {'absolute': 3, 'relative': 0}, **json.loads(os.environ.get('COMMANDER_CHANGE_THRESHOLDS') or '{}')}
+
+_snapshot = {'week': None, 'players': None}
+_snapshot_lock = threading.Lock()
+
+
+def player_key(player: dict) -> str:
+    return f"{player.get('team')}|{player.get('player')}"
+
+
+def match(previous: dict, current: dict) -> dict:
+    """
+    {previous key: current key} for the players in both snapshots. Players are matched on their id when both sides
+    have one and on team and name otherwise, so a projection gaining or losing its id doesn't read as one player
+    dropping out and another coming in
+    """
+
+    ids = {player.get('player_id'): key for key, player in current.items() if player.get('player_id') is not None}
+    matched = {}
+
+    for key, old in previous.items():
+
+        if old.get('player_id') is not None and old.get('player_id') in ids:
+            matched[key] = ids.get(old.get('player_id'))
+            continue
+
+        new = current.get(player_key(old))
+
+        if new is not None and (old.get('player_id') is None or new.get('player_id') is None):
+            matched[key] = player_key(old)
+
+    return matched
+
+
+def snapshot(projections: dict) -> dict:
+    """ {player_key: projection in every format} from parse_projections' {team: {position: {name: ...}}} """
+
+    players = {}
+
+    for team, team_data in projections.items():
+        for position, position_data in team_data.items():
+            for name, scoring in position_data.items():
+                player = {'player': name, 'team': team, 'position': position, 'player_id': scoring.get('player_id')}
+                player.update({scoring_format: scoring.get(scoring_format, 0) for scoring_format in FORMATS})
+                players[player_key(player)] = player
+
+    return players
+
+
+def exceeds(position: str, old: float, new: float) -> bool:
+
+    threshold = {**THRESHOLDS.get('default'), **THRESHOLDS.get(position, {})}
+    difference = abs(new - old)
+
+    if difference <= threshold.get('absolute', 0):
+        return False
+
+    return not old or difference / abs(old) > threshold.get('relative', 0)
+
+
+def detect(week: int, current: dict, runtime: str, empty: set = ()) -> list:
+    """
+    Change records for every player and format that moved past its position's thresholds since the previous
+    snapshot of the week. Players new to the week count as moving up from 0 and players who dropped out as moving
+    down to 0. The first snapshot of a week has nothing to compare against and records nothing.
+
+    empty holds the (position, format) pairs whose rankings page came back without players. Those keep their
+    previous projections in current instead of all dropping to 0, so a failed scrape neither floods the changes nor
+    gets saved as the next baseline.
+    """
+
+    previous = load(week)
+
+    if not previous:
+        return []
+
+    matched = match(previous, current)
+
+    for key, old in previous.items():
+        for scoring_format in FORMATS:
+            if (old.get('position'), scoring_format) in empty:
+                matched.setdefault(key, player_key(old))
+                player = current.setdefault(matched.get(key), {**{field: old.get(field) for field in ('player', 'team', 'position', 'player_id')}, **dict.fromkeys(FORMATS, 0)})
+                player[scoring_format] = old.get(scoring_format)
+
+    paired = set(matched.values())
+    pairs = [(old, current.get(matched.get(key), {})) for key, old in previous.items()]
+    pairs.extend(({}, new) for key, new in current.items() if key not in paired)
+
+    changes = []
+
+    for old, new in pairs:
+
+        player = new or old
+
+        for scoring_format in FORMATS:
+
+            before = old.get(scoring_format) or 0
+            after = new.get(scoring_format) or 0
+
+            if exceeds(player.get('position'), before, after):
+                changes.append({
+                    'player': player.get('player'),
+                    'team': player.get('team'),
+                    'scoring': scoring_format,
+                    'old': before,
+                    'new': after,
+                    'updated': runtime,
+                })
+
+    return changes
+
+
+def load(week: int) -> dict:
+    """
+    The previous snapshot of the week: kept in memory, then on disk across restarts. Only when neither has the week,
+    as on a fresh instance, is it rebuilt from the stored projections, whose rows keep each player's position.
+    """
+
+    with _snapshot_lock:
+
+        if _snapshot.get('week') == week:
+            return _snapshot.get('players')
+
+        players = None
+
+        if os.path.exists(SNAPSHOT_PATH):
+            with gzip.open(SNAPSHOT_PATH, 'rt') as f:
+                saved = json.load(f)
+            if saved.get('week') == week:
+                players = saved.get('players')
+
+        if players is None:
+            players = {player_key(row): row for row in map(dict, get_store().select('projections', {'week': week}))}
+
+        _snapshot.update({'week': week, 'players': players})
+
+        return players
+
+
+def save(week: int, players: dict):
+
+    with _snapshot_lock:
+
+        # Most refreshes move nothing, and the file already holds the same snapshot
+        if _snapshot.get('week') == week and _snapshot.get('players') == players and os.path.exists(SNAPSHOT_PATH):
+            return
+
+        _snapshot.update({'week': week, 'players': players})
+
+        os.makedirs(DATA_DIR, exist_ok=True)
+
+        with gzip.open(f"{SNAPSHOT_PATH}.tmp", 'wt') as f:
+            f.write(json.dumps({'week': week, 'players': players}, separators=(',', ':')))
+
+        os.replace(f"{SNAPSHOT_PATH}.tmp", SNAPSHOT_PATH)
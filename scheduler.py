@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+
+LIVE_INTERVAL = int(os.environ.get('COMMANDER_LIVE_INTERVAL', 60))
+PREGAME_INTERVAL = int(os.environ.get('COMMANDER_PREGAME_INTERVAL', 300))
+IDLE_INTERVAL = int(os.environ.get('COMMANDER_IDLE_INTERVAL', 3600))
+PROJECTIONS_INTERVAL = int(os.environ.get('COMMANDER_PROJECTIONS_INTERVAL', 3600))
+TEAMS_INTERVAL = int(os.environ.get('COMMANDER_TEAMS_INTERVAL', 86400))
+PREGAME_LEAD = 1800
+
+
+def score_interval(live: bool, next_kickoff: float = None) -> float:
+    """ Seconds until the next score refresh: fast while games are live, slower before kickoff, and idle otherwise """
+
+    if live:
+        return LIVE_INTERVAL
+
+    if next_kickoff is not None and next_kickoff <= PREGAME_LEAD:
+        return PREGAME_INTERVAL
+
+    if next_kickoff is not None:
+        return max(PREGAME_INTERVAL, min(IDLE_INTERVAL, next_kickoff - PREGAME_LEAD))
+
+    return IDLE_INTERVAL
+
+
+class Scheduler:
+    """
+    Runs ingest jobs in a background thread. Each job's interval callable is asked after every run how long to wait
+    before the next one, and runs never overlap with each other or with anything else holding the lock.
+    """
+
+    def __init__(self, lock: threading.Lock, poll: float = 5):
+        self.lock = lock
+        self.poll = poll
+        self.jobs = []
+        self.thread = None
+
+    def add(self, name: str, run, interval):
+        self.jobs.append({'name': name, 'run': run, 'interval': interval, 'due': 0})
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name='scheduler', daemon=True)
+            self.thread.start()
+
+    def loop(self):
+
+        while True:
+
+            job = min(self.jobs, key=lambda x: x.get('due'))
+            wait = job.get('due') - time.monotonic()
+
+            if wait > 0:
+                time.sleep(min(wait, self.poll))
+                continue
+
+            if not self.lock.acquire(blocking=False):
+                job['due'] = time.monotonic() + self.poll
+                continue
+
+            try:
+                job.get('run')()
+            except Exception as e:
+                print(f"scheduler: {job.get('name')} failed: {e!r}")
+            finally:
+                self.lock.release()
+
+            try:
+                job['due'] = time.monotonic() + job.get('interval')()
+            except Exception as e:
+                print(f"scheduler: {job.get('name')} interval failed: {e!r}")
+                job['due'] = time.monotonic() + IDLE_INTERVAL
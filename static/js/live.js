@@ -0,0 +1,32 @@
+(function () {
+
+    // Without server-sent events, fall back to reloading the whole scoreboard every minute
+    if (!window.EventSource) {
+        setTimeout(function () { window.location.reload(); }, 60000);
+        return;
+    }
+
+    var source = new EventSource(document.body.dataset.stream);
+
+    source.addEventListener('update', function (event) {
+        var fragments = JSON.parse(event.data);
+        Object.keys(fragments).forEach(function (id) {
+            var element = document.getElementById(id);
+            if (element) {
+                element.outerHTML = fragments[id];
+            }
+        });
+    });
+
+    source.addEventListener('reload', function () {
+        window.location.reload();
+    });
+
+    // Streams refused or failed for good aren't retried by the browser, so fall back the same way
+    source.addEventListener('error', function () {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(function () { window.location.reload(); }, 60000);
+        }
+    });
+
+})();
@@ -0,0 +1,516 @@
+import datetime
+import os
+import sqlite3
+import threading
+import uuid
+
+from google.api_core.exceptions import GoogleAPIError
+from google.cloud import bigquery
+
+
+DATA_DIR = os.environ.get('COMMANDER_DATA_DIR', 'data')
+
+TABLES = {
+    'leagues': 'commander.leagues',
+    'teams': 'commander.teams',
+    'projections': 'commander.projections',
+    'scores': 'commander.scores',
+    'matchups': 'commander.matchups',
+    'game_progress': 'commander.game_progress',
+    'changes': 'commander.changes',
+    'history': 'commander.history',
+    'slots': 'commander.slots',
+}
+
+SCHEMAS = {
+    'leagues': [
+        {"name": "profile",     "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "name",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "platform",    "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "scoring",     "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team_id",     "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "start_year",  "type": "INTEGER",  "mode": "NULLABLE"},
+        {"name": "swid",        "type": "STRING",   "mode": "NULLABLE"},
+        {"name": "s2",          "type": "STRING",   "mode": "NULLABLE"},
+    ],
+    'teams': [
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team_id",     "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "owner",       "type": "STRING",   "mode": "REQUIRED"},
+    ],
+    'projections': [
+        {"name": "player",          "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "player_id",       "type": "INTEGER",  "mode": "NULLABLE"},
+        {"name": "team",            "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "position",        "type": "STRING",   "mode": "NULLABLE"},
+        {"name": "week",            "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "standard",        "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "half-point-ppr",  "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "ppr",             "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "updated",         "type": "DATETIME", "mode": "REQUIRED"},
+    ],
+    'scores': [
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team_id",     "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "name",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "player_id",   "type": "INTEGER",  "mode": "NULLABLE"},
+        {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "status",      "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "position",    "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "slot",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "points",      "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "play_status", "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "gametime",    "type": "DATETIME", "mode": "REQUIRED"},
+        {"name": "updated",     "type": "DATETIME", "mode": "REQUIRED"},
+    ],
+    'matchups': [
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "home",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "away",        "type": "INTEGER",  "mode": "REQUIRED"},
+    ],
+    'game_progress': [
+        {"name": "year",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "progress",    "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "display",     "type": "STRING",   "mode": "REQUIRED"},
+    ],
+    'changes': [
+        {"name": "player",      "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "team",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "scoring",     "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "old",         "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "new",         "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "updated",     "type": "DATETIME", "mode": "REQUIRED"},
+    ],
+    'history': [
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "year",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "week",        "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "matchup_id",  "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "team_id",     "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "owner",       "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "score",       "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "projected",   "type": "FLOAT",    "mode": "REQUIRED"},
+        {"name": "diff",        "type": "FLOAT",    "mode": "REQUIRED"},
+    ],
+    'slots': [
+        {"name": "league_id",   "type": "INTEGER",  "mode": "REQUIRED"},
+        {"name": "slot",        "type": "STRING",   "mode": "REQUIRED"},
+        {"name": "count",       "type": "INTEGER",  "mode": "REQUIRED"},
+    ],
+}
+
+# Natural key of each table. Rows sharing a key replace each other locally and are deduplicated on read in BigQuery.
+KEYS = {
+    'teams': ('league_id', 'team_id'),
+    'projections': ('week', 'team', 'player'),
+    'scores': ('league_id', 'team_id', 'week', 'name'),
+    'matchups': ('league_id', 'week', 'home'),
+    'game_progress': ('year', 'week', 'team'),
+    'history': ('league_id', 'year', 'week', 'team_id'),
+    'slots': ('league_id', 'slot'),
+}
+
+INDEXES = {
+    'leagues': [('profile',), ('league_id',)],
+    'scores': [('week', 'league_id')],
+    'matchups': [('week', 'league_id')],
+}
+
+# Tables maintained by hand in the archive; always read from there when one is configured.
+SOURCE_TABLES = ('leagues',)
+
+
+class Row(dict):
+    """ Dict row that also allows attribute access, like a BigQuery Row """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Store:
+
+    def select(self, table: str, filters: dict = None, order_by: list = None, limit: int = None) -> list:
+        raise NotImplementedError
+
+    def write(self, table: str, rows: list):
+        raise NotImplementedError
+
+    def upsert(self, table: str, rows: list):
+        """ Inserts rows, replacing any existing rows with the same KEYS """
+        raise NotImplementedError
+
+    def delete(self, table: str, filters: dict = None, before: str = None):
+        raise NotImplementedError
+
+    def delete_keys(self, table: str, keys: list):
+        """ Deletes the rows whose KEYS match any of the given key tuples, in one statement """
+        raise NotImplementedError
+
+
+class Batch:
+    """
+    Collects upserts from many leagues so a cycle commits one upsert per table, however many leagues added rows.
+    Safe to fill from worker threads.
+    """
+
+    def __init__(self, store: Store):
+        self.store = store
+        self.lock = threading.Lock()
+        self.rows = {}
+
+    def upsert(self, table: str, rows: list):
+        with self.lock:
+            self.rows.setdefault(table, []).extend(rows)
+
+    def commit(self):
+
+        with self.lock:
+            pending, self.rows = self.rows, {}
+
+        for table, rows in pending.items():
+            self.store.upsert(table, rows)
+
+
+class SQLiteStore(Store):
+
+    TYPES = {'INTEGER': 'INTEGER', 'FLOAT': 'REAL', 'STRING': 'TEXT', 'DATETIME': 'TEXT'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.create_tables()
+
+    def connection(self) -> sqlite3.Connection:
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.row_factory = lambda cursor, values: Row(zip([c[0] for c in cursor.description], values))
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+
+        return conn
+
+    def create_tables(self):
+
+        conn = self.connection()
+
+        with self.lock, conn:
+            for table, schema in SCHEMAS.items():
+                columns = [f'"{c["name"]}" {self.TYPES.get(c["type"])}' for c in schema]
+                if table in KEYS:
+                    columns.append(f"PRIMARY KEY ({', '.join(KEYS.get(table))})")
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({', '.join(columns)})")
+                # Columns added to a schema after the database was created
+                existing = {row.get('name') for row in conn.execute(f"PRAGMA table_info({table})")}
+                for c in schema:
+                    if c["name"] not in existing:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN "{c["name"]}" {self.TYPES.get(c["type"])}')
+                for index in INDEXES.get(table, []):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_{'_'.join(index)} ON {table} ({', '.join(index)})")
+
+    @staticmethod
+    def where(filters: dict = None, before: str = None) -> tuple:
+
+        clauses = []
+        params = []
+
+        for column, value in (filters or {}).items():
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                clauses.append(f'"{column}" IN ({", ".join("?" for _ in value)})' if value else '0')
+                params.extend(value)
+            else:
+                clauses.append(f'"{column}" = ?')
+                params.append(value)
+
+        if before:
+            clauses.append('updated < ?')
+            params.append(before)
+
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+    def select(self, table: str, filters: dict = None, order_by: list = None, limit: int = None) -> list:
+
+        where, params = self.where(filters)
+        query = f"SELECT * FROM {table}{where}"
+
+        if order_by:
+            query += f" ORDER BY {', '.join(order_by)}"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+
+        return self.connection().execute(query, params).fetchall()
+
+    def write(self, table: str, rows: list):
+
+        if not rows:
+            return
+
+        columns = [c.get('name') for c in SCHEMAS.get(table)]
+        quoted = ', '.join(f'"{c}"' for c in columns)
+        verb = 'INSERT OR REPLACE' if table in KEYS else 'INSERT'
+        query = f"{verb} INTO {table} ({quoted}) VALUES ({', '.join('?' for _ in columns)})"
+
+        conn = self.connection()
+
+        with self.lock, conn:
+            conn.executemany(query, [[row.get(c) for c in columns] for row in rows])
+
+    def upsert(self, table: str, rows: list):
+        self.write(table, rows)
+
+    def delete(self, table: str, filters: dict = None, before: str = None):
+
+        where, params = self.where(filters, before)
+        conn = self.connection()
+
+        with self.lock, conn:
+            conn.execute(f"DELETE FROM {table}{where}", params)
+
+    def delete_keys(self, table: str, keys: list):
+
+        if not keys:
+            return
+
+        match = ' AND '.join(f'"{key}" = ?' for key in KEYS.get(table))
+        conn = self.connection()
+
+        with self.lock, conn:
+            conn.executemany(f"DELETE FROM {table} WHERE {match}", [list(key) for key in keys])
+
+
+class BigQueryStore(Store):
+
+    TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'STRING': 'STRING', 'DATETIME': 'DATETIME'}
+
+    def __init__(self):
+        self.add_columns()
+
+    @property
+    def client(self) -> bigquery.Client:
+        return bigquery_client()
+
+    def add_columns(self):
+        """ Nullable columns added to a schema after the dataset was created, in one script, so writes naming them work """
+
+        statements = []
+
+        for table, schema in SCHEMAS.items():
+            nullable = [c for c in schema if c.get('mode') == 'NULLABLE']
+            if nullable and table not in SOURCE_TABLES:
+                columns = ', '.join(f"ADD COLUMN IF NOT EXISTS `{c.get('name')}` {self.TYPES.get(c.get('type'))}" for c in nullable)
+                statements.append(f"ALTER TABLE IF EXISTS `{TABLES.get(table)}` {columns}")
+
+        try:
+            self.query(';\n'.join(statements))
+        except GoogleAPIError as e:
+            # Reads still work; writes naming a missing column fail until it is added by hand
+            print(f"bigquery: could not add new columns: {e!r}")
+
+    def query(self, query: str, params: list = None) -> list:
+        job_config = bigquery.QueryJobConfig(query_parameters=params or [])
+        return [row for row in self.client.query(query, job_config=job_config).result()]
+
+    def where(self, table: str, filters: dict = None, before: str = None) -> tuple:
+
+        types = {c.get('name'): self.TYPES.get(c.get('type')) for c in SCHEMAS.get(table)}
+        clauses = []
+        params = []
+
+        for column, value in (filters or {}).items():
+            name = f"p{len(params)}"
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(f"`{column}` IN UNNEST(@{name})")
+                params.append(bigquery.ArrayQueryParameter(name, types.get(column), list(value)))
+            else:
+                clauses.append(f"`{column}` = @{name}")
+                params.append(bigquery.ScalarQueryParameter(name, types.get(column), value))
+
+        if before:
+            clauses.append("updated < @before")
+            params.append(bigquery.ScalarQueryParameter('before', 'DATETIME', before))
+
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ''), params
+
+    def select(self, table: str, filters: dict = None, order_by: list = None, limit: int = None) -> list:
+
+        where, params = self.where(table, filters)
+        columns = [c.get('name') for c in SCHEMAS.get(table)]
+
+        if table in KEYS and 'updated' in columns:
+            query = f"SELECT * EXCEPT (_rn) FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY {', '.join(KEYS.get(table))} ORDER BY updated DESC) AS _rn " \
+                    f"FROM `{TABLES.get(table)}`{where}) WHERE _rn = 1"
+        else:
+            query = f"SELECT * FROM `{TABLES.get(table)}`{where}"
+
+        if order_by:
+            query += f" ORDER BY {', '.join(order_by)}"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+
+        return self.query(query, params)
+
+    def write(self, table: str, rows: list):
+
+        if not rows:
+            return
+
+        job_config = bigquery.LoadJobConfig(schema=SCHEMAS.get(table), source_format='NEWLINE_DELIMITED_JSON')
+        self.client.load_table_from_json(rows, TABLES.get(table), job_config=job_config).result()
+
+    def upsert(self, table: str, rows: list):
+        """
+        Loads rows into a staging table and merges them in, so the whole batch costs one load and one query. Every
+        call gets its own staging table, so concurrent upserts of the same table can't load into each other's, and
+        one left behind by a crash expires on its own.
+        """
+
+        if not rows:
+            return
+
+        staging = bigquery.Table(f"{self.client.project}.{TABLES.get(table)}_staging_{uuid.uuid4().hex}", schema=SCHEMAS.get(table))
+        staging.expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        columns = [f"`{c.get('name')}`" for c in SCHEMAS.get(table)]
+        match = ' AND '.join(f"T.{key} = S.{key}" for key in KEYS.get(table))
+
+        self.client.create_table(staging)
+
+        try:
+            job_config = bigquery.LoadJobConfig(schema=SCHEMAS.get(table), source_format='NEWLINE_DELIMITED_JSON')
+            self.client.load_table_from_json(rows, staging, job_config=job_config).result()
+
+            self.query(
+                f"MERGE `{TABLES.get(table)}` T USING `{staging.reference}` S ON {match} "
+                f"WHEN MATCHED THEN UPDATE SET {', '.join(f'{c} = S.{c}' for c in columns)} "
+                f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) VALUES ({', '.join(f'S.{c}' for c in columns)})"
+            )
+        finally:
+            self.client.delete_table(staging, not_found_ok=True)
+
+    def delete(self, table: str, filters: dict = None, before: str = None):
+        where, params = self.where(table, filters, before)
+        self.query(f"DELETE FROM `{TABLES.get(table)}`{where or ' WHERE TRUE'}", params)
+
+    def delete_keys(self, table: str, keys: list):
+
+        if not keys:
+            return
+
+        types = {c.get('name'): self.TYPES.get(c.get('type')) for c in SCHEMAS.get(table)}
+        columns = KEYS.get(table)
+        structs = [
+            bigquery.StructQueryParameter(None, *[bigquery.ScalarQueryParameter(c, types.get(c), v) for c, v in zip(columns, key)])
+            for key in keys
+        ]
+        match = ' AND '.join(f"k.{c} = T.{c}" for c in columns)
+
+        self.query(
+            f"DELETE FROM `{TABLES.get(table)}` T WHERE EXISTS (SELECT 1 FROM UNNEST(@keys) k WHERE {match})",
+            [bigquery.ArrayQueryParameter('keys', 'STRUCT', structs)],
+        )
+
+
+class ArchivedStore(Store):
+    """ Serves reads from a local store and mirrors every write to an archive """
+
+    def __init__(self, primary: Store, archive: Store):
+        self.primary = primary
+        self.archive = archive
+        self.hydrated = set()
+        self.lock = threading.Lock()
+
+    def hydrate(self, table: str):
+        """ Copy an archived table into an empty local one, so a fresh instance starts with the last known data """
+
+        with self.lock:
+            if table in self.hydrated:
+                return
+            if not self.primary.select(table, limit=1):
+                self.primary.write(table, [dict(row) for row in self.archive.select(table)])
+            self.hydrated.add(table)
+
+    def select(self, table: str, filters: dict = None, order_by: list = None, limit: int = None) -> list:
+
+        if table in SOURCE_TABLES:
+            return self.archive.select(table, filters, order_by, limit)
+
+        if table not in self.hydrated:
+            self.hydrate(table)
+
+        return self.primary.select(table, filters, order_by, limit)
+
+    def write(self, table: str, rows: list):
+        self.primary.write(table, rows)
+        self.archive.write(table, rows)
+
+    def upsert(self, table: str, rows: list):
+        self.primary.upsert(table, rows)
+        self.archive.upsert(table, rows)
+
+    def delete(self, table: str, filters: dict = None, before: str = None):
+        self.primary.delete(table, filters, before)
+        self.archive.delete(table, filters, before)
+
+    def delete_keys(self, table: str, keys: list):
+        self.primary.delete_keys(table, keys)
+        self.archive.delete_keys(table, keys)
+
+
+_store = None
+_store_lock = threading.Lock()
+_bigquery_client = None
+_bigquery_client_lock = threading.Lock()
+
+
+def bigquery_client() -> bigquery.Client:
+    """ One client per process, so credentials are resolved once and its HTTP connections are reused """
+
+    global _bigquery_client
+
+    with _bigquery_client_lock:
+        if _bigquery_client is None:
+            _bigquery_client = bigquery.Client()
+
+    return _bigquery_client
+
+
+def get_store() -> Store:
+    """
+    COMMANDER_STORE picks the backend ('sqlite' or 'bigquery'). A SQLite store mirrors writes to BigQuery unless
+    COMMANDER_ARCHIVE is set to an empty string.
+    """
+
+    global _store
+
+    with _store_lock:
+
+        if _store is None:
+
+            backend = os.environ.get('COMMANDER_STORE', 'sqlite')
+            archive = os.environ.get('COMMANDER_ARCHIVE', 'bigquery')
+
+            if backend == 'bigquery':
+                _store = BigQueryStore()
+            else:
+                _store = SQLiteStore(os.environ.get('COMMANDER_DB', os.path.join(DATA_DIR, 'commander.db')))
+                if archive == 'bigquery':
+                    _store = ArchivedStore(_store, BigQueryStore())
+
+    return _store
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Throttle:
+    """
+    Shared gate for calls to one upstream: a token bucket caps the request rate, a semaphore caps concurrency,
+    failures are retried with exponential backoff and full jitter up to a retry budget, and a run of consecutive
+    failures opens a circuit that rejects calls until the cooldown has passed. Errors retryable rejects are raised
+    at once and don't count as failures of the upstream.
+    """
+
+    def __init__(self, rate: float, burst: int, concurrency: int, retries: int = 4, backoff: float = 0.5,
+                 max_backoff: float = 30, failure_threshold: int = 10, cooldown: float = 60, retry_on: tuple = (Exception,),
+                 retryable=lambda e: True):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.retry_on = retry_on
+        self.retryable = retryable
+
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+
+        self.failures = 0
+        self.opened = None
+
+    def take_token(self):
+
+        while True:
+
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+                self.refilled = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def check_circuit(self):
+        with self.lock:
+            if self.opened is not None and time.monotonic() - self.opened < self.cooldown:
+                raise CircuitOpen(f"circuit open for another {self.cooldown - (time.monotonic() - self.opened):.1f}s")
+
+    def record(self, success: bool):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened = time.monotonic()
+
+    def call(self, fn, *args, **kwargs):
+
+        for attempt in range(self.retries + 1):
+
+            self.check_circuit()
+            self.take_token()
+
+            try:
+                with self.slots:
+                    result = fn(*args, **kwargs)
+            except self.retry_on as e:
+                if not self.retryable(e):
+                    raise
+                self.record(False)
+                if attempt == self.retries:
+                    raise
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+
+            self.record(True)
+
+            return result
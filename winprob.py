@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+
+
+DRAWS = int(os.environ.get('COMMANDER_WINPROB_DRAWS', 20000))
+SEED = int(os.environ.get('COMMANDER_WINPROB_SEED', 0))
+CHUNK = 4_000_000
+
+# Rough spread of a full game's points as a fraction of the projection, by position
+SPREAD = {'QB': 0.4, 'RB': 0.55, 'WR': 0.6, 'TE': 0.65, 'K': 0.5, 'DST': 0.7}
+DEFAULT_SPREAD = 0.6
+
+
+def win_probabilities(teams: list, matchups: list, draws: int = DRAWS, seed: int = SEED) -> list:
+    """
+    Simulates every team's final score at once and returns the home side's chance of winning each matchup.
+
+    teams is a list of teams, each a list of (points, projection, remaining, position) tuples for the players that
+    count: current points, the full-game projection and the fraction of the player's game still to play. matchups is
+    a list of (home, away) indexes into teams. A player's remaining points are drawn from a normal distribution with
+    mean projection * remaining and a spread that shrinks as the game runs out. Ties count as half a win.
+    """
+
+    if not matchups:
+        return []
+
+    players = [(index, *player) for index, team in enumerate(teams) for player in team]
+
+    current = np.zeros(len(teams), dtype=np.float32)
+    np.add.at(current, [p[0] for p in players], [p[1] or 0 for p in players])
+
+    # Only players with something left to play need to be drawn
+    live = [p for p in players if p[3] > 0 and p[2]]
+
+    mean = np.array([p[2] * p[3] for p in live], dtype=np.float32)
+    sd = np.array([p[2] * SPREAD.get(p[4], DEFAULT_SPREAD) * np.sqrt(p[3]) for p in live], dtype=np.float32)
+
+    # Players are grouped by team, so each team's draws are one contiguous block of rows
+    owners, starts = np.unique(np.array([p[0] for p in live], dtype=np.intp), return_index=True)
+
+    home = np.array([m[0] for m in matchups], dtype=np.intp)
+    away = np.array([m[1] for m in matchups], dtype=np.intp)
+
+    rng = np.random.default_rng(seed)
+    wins = np.zeros(len(matchups))
+
+    # Draw in chunks so the players x draws matrix stays bounded however many leagues are simulated
+    step = max(1, min(draws, CHUNK // max(1, len(live))))
+
+    for start in range(0, draws, step):
+
+        size = min(step, draws - start)
+
+        totals = np.repeat(current[:, None], size, axis=1)
+
+        if len(live):
+            samples = rng.standard_normal((len(live), size), dtype=np.float32)
+            samples *= sd[:, None]
+            samples += mean[:, None]
+            totals[owners] += np.add.reduceat(samples, starts, axis=0)
+
+        diff = totals[home] - totals[away]
+        wins += (diff > 0).sum(axis=1) + 0.5 * (diff == 0).sum(axis=1)
+
+    return (wins / draws).tolist()